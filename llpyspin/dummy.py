@@ -1,3 +1,4 @@
+import os
 import time
 import queue
 import PySpin
@@ -87,6 +88,7 @@ class DummyAcquisitionProcess(mp.Process):
     def start(self):
         """Start acquisition"""
         self.started.value = 1
+        self.parent_pid = os.getpid()
         super().start()
         return
 
@@ -94,8 +96,9 @@ class DummyAcquisitionProcess(mp.Process):
         """
         """
 
-        while self.started.value:
-            while self.acquiring.value:
+        # exit if the camera process was terminated
+        while self.started.value and os.getppid() == self.parent_pid:
+            while self.acquiring.value and os.getppid() == self.parent_pid:
 
                 #
                 t0 = time.time()
@@ -117,6 +120,10 @@ class DummyAcquisitionProcess(mp.Process):
                     self.buffer.task_done()
                 self.buffer.put(image)
 
+        # nothing reads the buffer anymore (don't wait on flushing it)
+        if os.getppid() != self.parent_pid:
+            self.buffer.cancel_join_thread()
+
         return
 
     def stop(self):
@@ -268,6 +275,9 @@ class DummyCameraPointer():
         #
         self._streaming = False
 
+        # interrupt any blocking calls to GetNextImage
+        self._p.buffer.put(None)
+
         return
 
     def GetNextImage(self, timeout=100):
@@ -281,13 +291,29 @@ class DummyCameraPointer():
         if self._streaming is False:
             raise PySpin.SpinnakerException('Camera is not streaming')
 
+        # block indefinitely if the timeout is infinite
+        if timeout == PySpin.EVENT_TIMEOUT_INFINITE:
+            timeout = None
+        else:
+            timeout = timeout / 1000
+
         #
-        try:
-            noise = self._p.buffer.get(timeout=timeout / 1000)
-            self._p.buffer.task_done()
+        while True:
+            try:
+                noise = self._p.buffer.get(timeout=timeout)
+                self._p.buffer.task_done()
+
+            except queue.Empty:
+                raise PySpin.SpinnakerException('No buffered images available') from None
+
+            # acquisition was ended while waiting (skip stale interrupts)
+            if noise is None:
+                if self._streaming is False:
+                    raise PySpin.SpinnakerException('Acquisition was ended')
+                else:
+                    continue
 
-        except queue.Empty:
-            raise PySpin.SpinnakerException('No buffered images available') from None
+            break
 
         pointer = PySpin.Image_Create(self.Width.GetValue(), self.Height.GetValue(), 0, 0, self.PixelFormat.GetValue(), noise)
 
@@ -1,6 +1,7 @@
 # imports
 import os
-import dill
+import time
+import queue
 import PySpin
 import logging
 import numpy as np
@@ -10,15 +11,195 @@ from datetime import datetime as dt
 
 # relative imports
 from .dummy import DummyCameraPointer
-from .processes import MainProcess, ChildProcess, CameraError, queued, GETBY_DUMMY_CAMERA, GETBY_DEVICE_INDEX, GETBY_SERIAL_NUMBER
-from .recording import FFmpegVideoWriter, SpinnakerVideoWriter, OpenCVVideoWriter, VideoWritingError
+from .processes import MainProcess, ChildProcess, CameraError, queued, handler, image_getter, announce_user_buffers, GETBY_DUMMY_CAMERA, GETBY_DEVICE_INDEX, GETBY_SERIAL_NUMBER
+from .recording import Backend, WRITERS, VideoWritingThread, VideoWritingError
 from .secondary import SecondaryCamera
 
+@handler('primary')
+def _record(child, pointer, **kwargs):
+    """
+    Prime the camera and record video (called in the child process)
+
+    Notes
+    -----
+    This is a special case in which the queued decorator won't work because
+    trying to retrieve the result from the child's output queue will cause the
+    main process to hang.
+    """
+
+    #
+    if pointer.IsValid() is False:
+        return (False, None, 'Camera pointer object is not valid')
+
+    # Set the dummy flag
+    dummy = isinstance(pointer, DummyCameraPointer)
+
+    # initialize the video writer (and send the result back to the main process)
+    try:
+        backend = kwargs['backend']
+        writer = WRITERS[backend](color=kwargs['color'], interpolation=kwargs['interpolation'])
+        writer.open(kwargs['filename'], kwargs['shape'], kwargs['framerate'], kwargs['bitrate'])
+        item = (True, None)
+        child.oq.put(item)
+
+    except VideoWritingError as error:
+        item = (
+            False, f'Failed to open video writer (backend={backend.name}): {error}'
+        )
+        child.oq.put(item)
+        return (None, None, None)
+
+    # acquisition
+    thread = None
+    n = 0
+    try:
+
+        # raw timestamps (in ns) and frame ids are stored in shared memory
+        # (timestamps are converted after acquisition is stopped)
+        timestamps = np.frombuffer(child.timestamps, dtype=np.int64)
+        frame_ids = np.frombuffer(child.frame_ids, dtype=np.int64)
+        capacity = timestamps.size
+        child.timestamp_count.value = 0
+
+        # set the number of buffered images (clamped to the device's limits)
+        buffer_count = kwargs['buffer_count']
+        if buffer_count is not None:
+            maximum = pointer.TLStream.StreamBufferCountManual.GetMax()
+            buffer_count = int(min(max(buffer_count, 1), maximum))
+            pointer.TLStream.StreamBufferCountManual.SetValue(buffer_count)
+        else:
+            buffer_count = pointer.TLStream.StreamBufferCountManual.GetValue()
+
+        # preallocate the stream buffers (if requested)
+        if kwargs['user_buffers']:
+            announce_user_buffers(child, pointer, buffer_count)
+
+        # write (and release) frames from a separate thread (which holds at
+        # most all but two of the stream buffers so the driver always has
+        # buffers to fill when the writer falls behind)
+        queue_size = max(buffer_count - 2, 1)
+        thread = VideoWritingThread(writer, maxsize=queue_size, release=not dummy)
+
+        # local references (avoids repeated lookups in the loops below)
+        timeout = kwargs['timeout']
+        safe_get = image_getter(pointer)
+        acquiring = child.acquiring
+        shared_frame_counter = child.shared_frame_counter
+        submit_many = thread.submit_many
+        monotonic_ns = time.monotonic_ns
+
+        # use the host's monotonic clock instead of the camera's timestamps if
+        # requested (dummy cameras don't have meaningful timestamps)
+        hardware_timestamps = kwargs['hardware_timestamps'] and not dummy
+
+        # wait for the trigger event (everything above is set up in advance so
+        # that acquisition begins as soon as the camera is triggered)
+        child.trigger.wait()
+
+        # begin acquisition
+        pointer.BeginAcquisition()
+
+        # main acquisition loop (after the acquisition flag is unset the same
+        # loop empties out the host computer's device buffer)
+        draining = False
+        grabbed = 0
+        while True:
+
+            # Suspend image acquisition to empty out the device buffer
+            if not draining and not acquiring.value:
+                pointer.TriggerMode.SetValue(PySpin.TriggerMode_On)
+                draining = True
+
+            # Wait for the next frame (the device buffer is empty once this
+            # times out while draining)
+            frame = safe_get(timeout)
+            if frame is None:
+                if draining:
+                    break
+                continue
+
+            # Collect any other frames which are already buffered
+            batch = [frame]
+            while len(batch) < queue_size:
+                frame = safe_get(0)
+                if frame is None:
+                    break
+                batch.append(frame)
+
+            # Increment the shared frame counter
+            shared_frame_counter.value += len(batch)
+
+            # Write the frames to the video container (incomplete frames are
+            # returned to the device buffer)
+            complete = list()
+            for frame in batch:
+                frame_id = grabbed
+                grabbed += 1
+                if frame.IsIncomplete():
+                    frame.Release()
+                    continue
+                if n < capacity:
+                    if hardware_timestamps:
+                        timestamps[n] = frame.GetTimeStamp()
+                    else:
+                        timestamps[n] = monotonic_ns()
+                    frame_ids[n] = frame_id
+                n += 1
+                complete.append(frame)
+            submit_many(complete)
+
+        # write any remaining frames
+        thread.close()
+        thread = None
+
+        # stop acquisition immediately
+        pointer.EndAcquisition()
+
+        # turn the trigger mode back off
+        pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+
+        #
+        try:
+            writer.close()
+        except VideoWritingError as error:
+            return False, None, f'Failed to close video writer (backend={backend.name}): {error}'
+
+        return True, None, None
+
+    except VideoWritingError as error:
+        return False, None, f'Failed to write video (backend={backend.name}): {error}'
+
+    except PySpin.SpinnakerException:
+        return False, None, f'Video acquisition failed'
+
+    finally:
+
+        # write (or release) any remaining frames, stop acquisition and close
+        # the video writer (also after a failure)
+        if thread is not None:
+            try:
+                thread.close()
+            except VideoWritingError:
+                pass
+        try:
+            if pointer.IsStreaming():
+                pointer.EndAcquisition()
+            pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+        except PySpin.SpinnakerException:
+            pass
+        if writer.p is not None:
+            try:
+                writer.close()
+            except VideoWritingError:
+                pass
+
+        child.timestamp_count.value = n
+
 class PrimaryCameraChildProcess(ChildProcess):
     """
     """
 
-    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX) -> None:
+    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX, cpu_affinity=None, realtime=False):
         """
         """
 
@@ -26,7 +207,10 @@ class PrimaryCameraChildProcess(ChildProcess):
         self.trigger = mp.Event()
 
         # init
-        super().__init__(value, getby)
+        super().__init__(value, getby, cpu_affinity, realtime)
+
+        # timestamps of recorded frames
+        self.allocate_timestamp_buffers()
 
         return
 
@@ -39,14 +223,21 @@ class PrimaryCamera(MainProcess):
         device_index  : int=None,
         nickname      : str=None,
         dummy         : bool=False,
-        color         : bool=False
+        color         : bool=False,
+        cpu_affinity  : int=None,
+        realtime      : bool=False,
+        shutdown_timeout : float=0.5
         ):
         """
         """
 
-        super().__init__(serial_number, device_index, nickname, dummy, color)
+        super().__init__(serial_number, device_index, nickname, dummy, color, cpu_affinity, realtime)
         self._spawn_child_process(PrimaryCameraChildProcess)
         self._primed = False
+
+        # interval (in seconds) for checking the child process while stopping
+        self._shutdown_timeout = shutdown_timeout
+
         return
 
     def prime(
@@ -54,11 +245,21 @@ class PrimaryCamera(MainProcess):
         filename: str,
         bitrate: int=1000000,
         backend: str='Spinnaker',
-        timeout: int=1
+        timeout: int=1,
+        interpolation: str='nearest',
+        buffer_count: int=None,
+        hardware_timestamps: bool=True,
+        user_buffers: bool=False
         ):
         """
         """
 
+        # resolve the video writing backend (before sending it to the child)
+        try:
+            backend = Backend.from_string(backend)
+        except VideoWritingError as error:
+            raise CameraError(str(error)) from None
+
         # stop acquisition if prime is called before the trigger method
         if self.primed:
             self.stop()
@@ -76,22 +277,16 @@ class PrimaryCamera(MainProcess):
             self._child.shared_frame_counter.value = 0
 
         # set the buffer handling mode to oldest first (instead of newest only)
-        # and increase the number of bufered images allowed in memory
+        # and configure the camera to emit a digital signal (in a single
+        # round trip through the queues)
         @queued
         def f(child, pointer, **kwargs):
+
             try:
                 pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_OldestFirst)
-                return True, None, None
             except PySpin.SpinnakerException:
                 return False, None, f'Failed to set the stream buffer handling mode property'
 
-        # call the function
-        result, output, message = f(main=self)
-
-        # configure the camera to emit a digital signal
-        @queued
-        def f(child, pointer, **kwargs):
-
             try:
                 pointer.LineSelector.SetValue(PySpin.LineSelector_Line1)
                 pointer.LineSource.SetValue(PySpin.LineSource_ExposureActive)
@@ -106,134 +301,6 @@ class PrimaryCamera(MainProcess):
         # call the function
         result, output, message = f(main=self)
 
-        # prime the camera for acquisition
-        # NOTE - This is a special case in which the queued decorator won't
-        #        work because trying to retrieve the result from the child's
-        #        output queue will cause the main process to hang.
-        def f(child, pointer, **kwargs):
-
-            #
-            if pointer.IsValid() is False:
-                return (False, None, 'Camera pointer object is not valid')
-
-            # Set the dummy flag
-            dummy = isinstance(pointer, DummyCameraPointer)
-
-            # initialize the video writer (and send the result back to the main process)
-            try:
-                backend = kwargs['backend']
-                if backend in ['ffmpeg', 'FFmpeg']:
-                    writer = FFmpegVideoWriter(color=kwargs['color'])
-                elif backend in ['spinnaker', 'Spinnaker', 'PySpin']:
-                    writer = SpinnakerVideoWriter(color=kwargs['color'])
-                elif backend in ['opencv', 'OpenCV', 'cv2']:
-                    writer = OpenCVVideoWriter(color=kwargs['color'])
-                else:
-                    item = (
-                        False, f'{backend} is not a valid video writing backend'
-                    )
-                    child.oq.put(item)
-                    return (None, None, None)
-
-                writer.open(kwargs['filename'], kwargs['shape'], kwargs['framerate'], kwargs['bitrate'])
-                item = (True, None)
-                child.oq.put(item)
-
-            except VideoWritingError as error:
-                item = (
-                    False, f'Failed to open video writer (backend={backend}): {error}'
-                )
-                child.oq.put(item)
-                return (None, None, None)
-
-            # acquisition
-            try:
-
-                # list of timestamps
-                timestamps = list()
-
-                # wait for the trigger event
-                child.trigger.wait()
-
-                # begin acquisition
-                pointer.BeginAcquisition()
-
-                # main acquisition loop
-                while child.acquiring.value:
-
-                    try:
-
-                        # Grab the next frame from the buffer
-                        frame = pointer.GetNextImage(kwargs['timeout'])
-
-                        # Increment the shared frame counter
-                        child.shared_frame_counter.value += 1
-
-                        # Write the frame to the video container
-                        if frame.IsIncomplete():
-                            continue
-                        elif dummy:
-                            writer.write(frame)
-                        else:
-                            if len(timestamps) == 0:
-                                t0 = frame.GetTimeStamp()
-                                timestamps.append(0.0)
-                            else:
-                                tn = (frame.GetTimeStamp() - t0) / 1000000
-                                timestamps.append(tn)
-                            writer.write(frame)
-                            frame.Release()
-
-                    except PySpin.SpinnakerException:
-                        continue
-
-                # Suspend image acquisition to empty out the device buffer
-                pointer.TriggerMode.SetValue(PySpin.TriggerMode_On)
-
-                # Empty out the host computer's device buffer
-                while True:
-                    try:
-
-                        # Grab the next frame from the buffer
-                        frame = pointer.GetNextImage(kwargs['timeout'])
-
-                        # Increment the shared frame counter
-                        child.shared_frame_counter.value += 1
-
-                        if frame.IsIncomplete():
-                            continue
-                        elif dummy:
-                            writer.write(frame)
-                        else:
-                            if len(timestamps) == 0:
-                                t0 = frame.GetTimeStamp()
-                                timestamps.append(0.0)
-                            else:
-                                tn = (frame.GetTimeStamp() - t0) / 1000000
-                                timestamps.append(tn)
-                            writer.write(frame)
-                            frame.Release()
-
-                    except PySpin.SpinnakerException:
-                        break
-
-                # stop acquisition immediately
-                pointer.EndAcquisition()
-
-                # turn the trigger mode back off
-                pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
-
-                #
-                try:
-                    writer.close()
-                except:
-                    return False, timestamps, f'Failed to close video writer (backend={backend})'
-
-                return True, timestamps, None
-
-            except PySpin.SpinnakerException:
-                return False, None, f'Video acquisition failed'
-
         # kwargs for configuring up the video writing
         kwargs = {
             'filename'  : filename,
@@ -242,11 +309,15 @@ class PrimaryCamera(MainProcess):
             'bitrate'   : bitrate,
             'backend'   : backend,
             'timeout'   : timeout,
-            'color'     : self.color
+            'color'     : self.color,
+            'interpolation' : interpolation,
+            'buffer_count'  : buffer_count,
+            'hardware_timestamps' : hardware_timestamps,
+            'user_buffers'        : user_buffers
         }
 
         # place the function in the input queue
-        item = (dill.dumps(f), kwargs)
+        item = ('primary', kwargs)
         self._child.iq.put(item)
 
         # check that the video writing setup was successful
@@ -277,9 +348,15 @@ class PrimaryCamera(MainProcess):
 
         return
 
-    def stop(self):
+    def stop(self, timeout=10):
         """
         Stop video acquisition
+
+        Keywords
+        --------
+        timeout : float
+            Time (in seconds) to wait for the child process to finish writing
+            the video before it is terminated
         """
 
         if not self.primed:
@@ -294,15 +371,36 @@ class PrimaryCamera(MainProcess):
             self._child.trigger.set()
 
         # retrieve the result of video acquisition from the child's output queue
-        result, timestamps, message = self._child.oq.get()
-        if result == False:
-            raise CameraError(message)
+        # (without waiting on a child process that has died or hangs)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result, output, message = self._child.oq.get(timeout=self._shutdown_timeout)
+                break
+            except queue.Empty:
+                if not self._child.is_alive():
+                    self._primed = False
+                    self._locked = False
+                    self._child = None
+                    raise CameraError('Child process died during acquisition') from None
+                if time.monotonic() > deadline:
+                    self._child.terminate()
+                    self._child.join()
+                    self._primed = False
+                    self._locked = False
+                    self._child = None
+                    raise CameraError('Child process was terminated after failing to stop acquisition') from None
 
         # reset the primed and locked flags
         self._primed = False
         self._locked = False
 
-        return np.array(timestamps)
+        if result == False:
+            raise CameraError(message)
+
+        timestamps, self._frame_ids = self._collect_timestamps()
+
+        return timestamps
 
     def release(self):
         """
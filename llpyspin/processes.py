@@ -1,10 +1,14 @@
 import dill
+import math
 import types
 import queue
+import ctypes
 import PySpin
+import warnings
 import numpy as np
 import multiprocessing as mp
 from .dummy import DummyCameraPointer
+from .utilities import set_scheduling
 
 # Method for identifying camera devices
 GETBY_DUMMY_CAMERA  = 0
@@ -12,19 +16,144 @@ GETBY_SERIAL_NUMBER = 1
 GETBY_DEVICE_INDEX  = 2
 
 # Shared frame counter (to keep primary and secondary cameras grossly in sync)
-SHARED_FRAME_COUNTER = mp.Value('i', 0)
+SHARED_FRAME_COUNTER = mp.Value('i', 0, lock=False)
+
+# Maximum number of timestamps recorded per acquisition (~3 hours at 200 fps)
+TIMESTAMP_BUFFER_SIZE = 2 ** 21
+
+# Functions which the child process can call by name
+HANDLERS = dict()
+
+# Interval (in seconds) for checking the started flag while waiting for commands
+COMMAND_POLLING_INTERVAL = 0.01
 
 class CameraError(Exception):
     """"""
     def __init__(self, message: str) -> None:
         super().__init__(message)
 
+class Channel():
+    """
+    A one-way pipe with the subset of the multiprocessing.Queue interface used
+    to pass commands and results between the main and child processes
+
+    Notes
+    -----
+    Items are sent straight through the pipe instead of being handed off to a
+    feeder thread. There is exactly one producer and one consumer per channel.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        return
+
+    def put(self, item):
+        self._writer.send(item)
+        return
+
+    def get(self, block=True, timeout=None):
+        """
+        Raises queue.Empty if no item is available (like multiprocessing.Queue)
+        """
+
+        if not block:
+            timeout = 0
+        if not self._reader.poll(timeout):
+            raise queue.Empty
+        return self._reader.recv()
+
+    def empty(self):
+        return not self._reader.poll()
+
+    def flush(self):
+        """
+        Discard any items which haven't been retrieved
+        """
+
+        while self._reader.poll():
+            self._reader.recv()
+
+        return
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+        return
+
+def handler(name):
+    """
+    This decorator registers a function with the child process so that only
+    its name (instead of the dill-pickled function) is sent through the input
+    queue
+    """
+
+    def register(f):
+        HANDLERS[name] = f
+        f.handler_name = name
+        return f
+
+    return register
+
+def image_getter(pointer):
+    """
+    Wrap a camera's GetNextImage method so that it returns None instead of
+    raising an exception when no image is available
+    """
+
+    get_next_image = pointer.GetNextImage
+
+    def safe_get(timeout):
+        try:
+            return get_next_image(timeout)
+        except PySpin.SpinnakerException:
+            return None
+
+    return safe_get
+
+def announce_user_buffers(child, pointer, buffer_count):
+    """
+    Allocate the camera's stream buffers in the child process and hand them to
+    the transport layer (instead of letting Spinnaker allocate them)
+
+    Returns
+    -------
+    result : bool
+        True if the camera accepted the buffers
+
+    Notes
+    -----
+    The buffers are kept on the child process because the camera keeps using
+    them after acquisition ends. Requires a version of Spinnaker which
+    supports user buffers (SetUserBuffers).
+    """
+
+    if not hasattr(pointer, 'SetUserBuffers'):
+        return False
+
+    try:
+        buffer_size = int(pointer.PayloadSize.GetValue())
+        total_size = buffer_size * buffer_count
+        buffers = child.user_buffers
+        if buffers is None or buffers.size != total_size:
+            buffers = np.zeros(total_size, dtype=np.uint8)
+        pointer.SetUserBuffers(buffers, total_size)
+    except (PySpin.SpinnakerException, TypeError) as error:
+        warnings.warn(f'Failed to set user buffers ({error}); falling back to the default allocation')
+        return False
+
+    child.user_buffers = buffers
+
+    return True
+
 def queued(f):
     """
     This decorator sends functions through the input queue and retrieves the
     result of the function call from the output queue
     """
 
+    # registered handlers are sent by name
+    name = getattr(f, 'handler_name', None)
+
     def wrapped(main, **kwargs):
         """
         Keywords
@@ -33,7 +162,7 @@ def queued(f):
             An instance of the MainProcess class
         """
 
-        item = (dill.dumps(f), kwargs)
+        item = (name if name is not None else dill.dumps(f), kwargs)
         main._child.iq.put(item)
         result, output, message = main._child.oq.get()
         if result is False:
@@ -43,11 +172,26 @@ def queued(f):
 
     return wrapped
 
+@handler('deinitialize')
+def _deinitialize(child, pointer, **kwargs):
+    """
+    End acquisition and deinitialize the camera
+    """
+
+    try:
+        if pointer.IsStreaming():
+            pointer.EndAcquisition()
+        if pointer.IsInitialized():
+            pointer.DeInit()
+        return True, None, None
+    except PySpin.SpinnakerException:
+        return False, None, 'Failed to deinitialize camera pointer object'
+
 class ChildProcess(mp.Process):
     """
     """
 
-    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX):
+    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX, cpu_affinity=None, realtime=False):
         """
         """
 
@@ -56,13 +200,27 @@ class ChildProcess(mp.Process):
         self.value = value
         self.getby = getby
 
-        # IO queues
-        self.iq = mp.Queue()
-        self.oq = mp.Queue()
+        # stream buffers allocated by the child process (see announce_user_buffers)
+        self.user_buffers = None
+
+        # scheduling (see utilities.set_scheduling)
+        self.cpu_affinity = cpu_affinity
+        self.realtime = realtime
+
+        # IO channels
+        self.iq = Channel()
+        self.oq = Channel()
+
+        # Shared memory flags (single word values which are only ever set by
+        # one process at a time so they don't need locks)
+        self.started   = mp.Value('i', 0, lock=False)
+        self.acquiring = mp.Value('i', 0, lock=False)
 
-        # Shared memory flags
-        self.started   = mp.Value('i', 0)
-        self.acquiring = mp.Value('i', 0)
+        # Shared buffers for the raw timestamps and frame ids (only allocated
+        # by child processes which record video, see allocate_timestamp_buffers)
+        self.timestamps = None
+        self.frame_ids = None
+        self.timestamp_count = None
 
         #
         global SHARED_FRAME_COUNTER
@@ -70,6 +228,18 @@ class ChildProcess(mp.Process):
 
         return
 
+    def allocate_timestamp_buffers(self) -> None:
+        """
+        Allocate the shared buffers for the raw timestamps and frame ids (and
+        the number of frames recorded)
+        """
+
+        self.timestamps = mp.RawArray(ctypes.c_int64, TIMESTAMP_BUFFER_SIZE)
+        self.frame_ids = mp.RawArray(ctypes.c_int64, TIMESTAMP_BUFFER_SIZE)
+        self.timestamp_count = mp.Value('q', 0, lock=False)
+
+        return
+
     def start(self) -> None:
         """
         Override the start method
@@ -85,6 +255,9 @@ class ChildProcess(mp.Process):
         """
         """
 
+        # pin the process to a CPU and/or raise its scheduling priority
+        set_scheduling(self.cpu_affinity, self.realtime)
+
         try:
 
             # create instances of the system and cameras list
@@ -124,9 +297,12 @@ class ChildProcess(mp.Process):
         while self.started.value:
 
             try:
-                # call the function
-                dilled, kwargs = self.iq.get(block=False)
-                f = dill.loads(dilled)
+                # call the function (either registered by name or dill-pickled)
+                item, kwargs = self.iq.get(timeout=COMMAND_POLLING_INTERVAL)
+                if isinstance(item, str):
+                    f = HANDLERS[item]
+                else:
+                    f = dill.loads(item)
                 result, output, message = f(child=self, pointer=pointer, **kwargs)
 
                 # output
@@ -135,14 +311,14 @@ class ChildProcess(mp.Process):
             except queue.Empty:
                 continue
 
-        # cleanup and emit signal
+        # cleanup and emit signal (the camera is deinitialized here instead of
+        # by a separate command from the main process)
         try:
-            if pointer.IsInitialized():
-                pointer.DeInit()
+            result, output, message = _deinitialize(child=self, pointer=pointer)
             del pointer
             cameras.Clear()
             system.ReleaseInstance()
-            self.oq.put(True)
+            self.oq.put(result)
 
         except PySpin.SpinnakerException:
             self.oq.put(False)
@@ -159,7 +335,9 @@ class MainProcess():
         device_index  : int=None,
         nickname      : str=None,
         dummy         : bool=False,
-        color         : bool=False
+        color         : bool=False,
+        cpu_affinity  : int=None,
+        realtime      : bool=False
         ):
         """
         """
@@ -191,6 +369,9 @@ class MainProcess():
         self._roi       = None
         self._stream_buffer_count = None
 
+        # frame ids from the most recent recording
+        self._frame_ids = None
+
         # acquisition lock state
         self._locked = False
 
@@ -206,6 +387,10 @@ class MainProcess():
         #
         self._color = color
 
+        # scheduling of the child process
+        self._cpu_affinity = cpu_affinity
+        self._realtime = realtime
+
         return
 
     def _spawn_child_process(self, cls : ChildProcess, **kwargs) -> None:
@@ -223,7 +408,7 @@ class MainProcess():
             self._join_child_process()
 
         # create and start the child process
-        self._child = cls(self.device, self.getby)
+        self._child = cls(self.device, self.getby, self._cpu_affinity, self._realtime)
         self._child.start()
         result = self._child.oq.get()
         if not result:
@@ -314,8 +499,8 @@ class MainProcess():
                     pointer.Width.GetValue(),
                     pointer.Height.GetValue(),
                 )
-                framerate = int(np.ceil(pointer.AcquisitionFrameRate.GetValue()))
-                exposure  = int(np.ceil(pointer.ExposureTime.GetValue()))
+                framerate = math.ceil(pointer.AcquisitionFrameRate.GetValue())
+                exposure  = math.ceil(pointer.ExposureTime.GetValue())
                 binsize   = (
                     pointer.BinningHorizontal.GetValue(),
                     pointer.BinningVertical.GetValue()
@@ -351,6 +536,36 @@ class MainProcess():
 
         return
 
+    def _collect_timestamps(self):
+        """
+        Read the timestamps and frame ids recorded by the child process from
+        shared memory
+
+        Returns
+        -------
+        timestamps : numpy.ndarray
+            Timestamps (in ms) relative to the first frame
+        frame_ids : numpy.ndarray
+            Index of each recorded frame among all grabbed frames (gaps
+            indicate incomplete or dropped frames)
+        """
+
+        count = self._child.timestamp_count.value
+        if count > TIMESTAMP_BUFFER_SIZE:
+            warnings.warn(f'Timestamps were only recorded for the first {TIMESTAMP_BUFFER_SIZE} of {count} frames')
+            count = TIMESTAMP_BUFFER_SIZE
+
+        raw = np.frombuffer(self._child.timestamps, dtype=np.int64, count=count)
+        frame_ids = np.frombuffer(self._child.frame_ids, dtype=np.int64, count=count).copy()
+        if count == 0:
+            return raw.astype(np.float64), frame_ids
+
+        # subtract in integer space (preserves precision) then scale ns to ms in place
+        timestamps = (raw - raw[0]).astype(np.float64)
+        timestamps *= 1e-6
+
+        return timestamps, frame_ids
+
     def _join_child_process(self, timeout: int=3) -> None:
         """
         """
@@ -361,30 +576,15 @@ class MainProcess():
         if self._child.started.value != 1:
             raise CameraError('Child process is inactive')
 
-        @queued
-        def f(child, pointer, **kwargs):
-            try:
-                if pointer.IsStreaming():
-                    pointer.EndAcquisition()
-                if pointer.IsInitialized():
-                    pointer.DeInit()
-                return True, None, None
-            except PySpin.SpinnakerException:
-                return False, None, 'Failed to deinitialize camera pointer object'
-
-        # Send the function through the queue
-        result, output, message = f(main=self)
-
-        # Break out of the main loop in the child process
+        # Break out of the main loop in the child process (which deinitializes
+        # the camera before exiting)
         self._child.started.value = 0
         result = self._child.oq.get()
 
-        # Flush the IO queues
+        # Flush the IO channels
         for q in [self._child.iq, self._child.oq]:
-            while q.qsize() != 0:
-                discard = q.get()
+            q.flush()
             q.close()
-            q.join_thread()
 
         # Attempt to join the child process
         self._child.join(timeout)
@@ -398,6 +598,9 @@ class MainProcess():
         else:
             self._child = None
 
+        if result is False:
+            raise CameraError('Failed to deinitialize camera pointer object')
+
         return
 
     # framerate
@@ -441,12 +644,11 @@ class MainProcess():
             except PySpin.SpinnakerException:
                 return False, None, f'Failed to determine the range of possible framerate values'
 
-            # Set framerate to maximum value
+            # Set framerate to maximum value (queried above)
             if value == 'max':
                 try:
-                    max = pointer.AcquisitionFrameRate.GetMax()
                     pointer.AcquisitionFrameRate.SetValue(max)
-                    return True, None, None
+                    return True, max, None
 
                 except PySpin.SpinnakerException:
                     return False, None, f'Failed to query exposure property'
@@ -460,14 +662,14 @@ class MainProcess():
             else:
                 try:
                     pointer.AcquisitionFrameRate.SetValue(value)
-                    check = int(np.around(pointer.AcquisitionFrameRate.GetValue()))
+                    check = round(pointer.AcquisitionFrameRate.GetValue())
 
                     if check != value:
                         message = f'Target framerate ({value:.1f} fps) does not equal new framerate ({check:.1f} fps)'
                         return False, None, message
 
                     else:
-                        return True, None, None
+                        return True, value, None
 
                 except PySpin.SpinnakerException:
                     message = f'Failed to set framerate to {value:.1f} fps'
@@ -476,9 +678,9 @@ class MainProcess():
         # call
         result, output, message = f(main=self, value=value)
 
-        # update data
+        # update data (with the resulting framerate in case of "max")
         if result:
-            self._framerate = value
+            self._framerate = output
 
         return
 
@@ -806,6 +1008,11 @@ class MainProcess():
 
         return output
 
+    # frame ids (from the most recent recording)
+    @property
+    def frame_ids(self):
+        return self._frame_ids
+
     # acquisition lock state
     @property
     def locked(self):
@@ -1,11 +1,19 @@
 import os
 import sys
 import queue
+import ctypes
+import warnings
 import PySpin
+import threading
+import collections
 import numpy as np
 import pathlib as pl
 import subprocess as sp
 import multiprocessing as mp
+from enum import IntEnum
+
+# relative imports
+from .utilities import restore_scheduling
 
 OPENCV_IMPORT_RESULT = False
 
@@ -61,10 +69,141 @@ def locate_ffmpeg_binary():
 # call the function
 locate_ffmpeg_binary()
 
+# Lossless encoder arguments for the GPU (NVENC) and the CPU (libx264)
+FFMPEG_NVENC_ENCODER = (
+    '-vcodec', 'h264_nvenc',
+    '-preset', 'p1',
+    '-tune', 'lossless',
+    '-delay', '0',
+    '-zerolatency', '1'
+)
+FFMPEG_X264_ENCODER = (
+    '-crf', '0',
+    '-vcodec', 'libx264',
+    '-preset', 'ultrafast',
+    '-tune', 'zerolatency'
+)
+
+# Result of the NVENC test encode (None until detect_nvenc_encoder is called)
+FFMPEG_NVENC_AVAILABLE = None
+
+def detect_nvenc_encoder():
+    """
+    Check if FFmpeg can actually encode with NVENC
+
+    Notes
+    -----
+    Listing h264_nvenc among FFmpeg's encoders only means FFmpeg was built with
+    it, so a single frame is encoded instead (which fails without an NVIDIA GPU
+    and driver, or if FFmpeg is too old for the lossless tuning). Each FFmpeg
+    writer process runs the test before it starts encoding and the result is
+    cached for the rest of that process.
+    """
+
+    global FFMPEG_NVENC_AVAILABLE
+
+    if FFMPEG_NVENC_AVAILABLE is not None:
+        return FFMPEG_NVENC_AVAILABLE
+
+    if FFMPEG_BINARY_FILEPATH is None:
+        FFMPEG_NVENC_AVAILABLE = False
+        return FFMPEG_NVENC_AVAILABLE
+
+    args = (
+        FFMPEG_BINARY_FILEPATH,
+        '-hide_banner',
+        '-f', 'lavfi',
+        '-i', 'color=black:s=256x256',
+        '-frames:v', '1',
+        '-pix_fmt', 'yuv420p',
+        *FFMPEG_NVENC_ENCODER,
+        '-f', 'null',
+        '-'
+    )
+    try:
+        result = sp.run(args, stdout=sp.DEVNULL, stderr=sp.DEVNULL, timeout=10)
+        FFMPEG_NVENC_AVAILABLE = result.returncode == 0
+    except (OSError, sp.TimeoutExpired):
+        FFMPEG_NVENC_AVAILABLE = False
+
+    return FFMPEG_NVENC_AVAILABLE
+
+# Number of frames the FFmpeg stdin pipe should be able to hold
+PIPE_FRAME_CAPACITY = 4
+
+def resize_pipe(fd, size):
+    """
+    Try to increase the capacity of a pipe (Linux only)
+    """
+
+    try:
+        import fcntl
+    except ModuleNotFoundError:
+        return
+
+    # F_SETPIPE_SZ isn't exposed by the fcntl module before Python 3.10
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+    try:
+        with open('/proc/sys/fs/pipe-max-size', 'r') as stream:
+            size = min(size, int(stream.read()))
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as error:
+        warnings.warn(f'Failed to resize pipe to {size} bytes: {error}')
+
+    return
+
 class VideoWritingError(Exception):
     def __init__(self, message):
         super().__init__(message)
 
+class Backend(IntEnum):
+    """
+    Video writing backends
+    """
+
+    FFMPEG    = 0
+    SPINNAKER = 1
+    OPENCV    = 2
+
+    @classmethod
+    def from_string(cls, value):
+        """
+        Look up a backend by name (case-insensitive)
+        """
+
+        aliases = {
+            'ffmpeg'    : cls.FFMPEG,
+            'spinnaker' : cls.SPINNAKER,
+            'pyspin'    : cls.SPINNAKER,
+            'opencv'    : cls.OPENCV,
+            'cv2'       : cls.OPENCV,
+            'cv'        : cls.OPENCV,
+        }
+
+        if isinstance(value, cls):
+            return value
+
+        try:
+            return aliases[str(value).lower()]
+        except KeyError:
+            raise VideoWritingError(f'{value} is not a valid video writing backend') from None
+
+# Color processing algorithms used when an image needs to be converted
+INTERPOLATION_METHODS = {
+    'none'    : PySpin.NO_COLOR_PROCESSING,
+    'nearest' : PySpin.NEAREST_NEIGHBOR,
+    'edge'    : PySpin.EDGE_SENSING,
+    'linear'  : PySpin.HQ_LINEAR,
+}
+
+# Number of slots in the shared frame ring
+FRAME_RING_SIZE = 8
+
+# Interval (in seconds) for checking that the writer process is still alive
+# while waiting for an empty slot
+WRITER_POLLING_INTERVAL = 0.1
+
 class VideoWriterChildProcess(mp.Process):
     """
     """
@@ -78,7 +217,7 @@ class VideoWriterChildProcess(mp.Process):
         # absolute file path to the movie
         self.filename = filename
 
-        # multiprocessing queue for image transfer
+        # multiprocessing queue for transferring the index of each filled slot
         self.q = mp.Queue()
 
         # started flag
@@ -89,18 +228,41 @@ class VideoWriterChildProcess(mp.Process):
         self.framerate = framerate
         self.color = color
 
+        # shared frame ring
+        self.shape = (self.height, self.width, 3) if color else (self.height, self.width)
+        self.pixels = mp.RawArray(ctypes.c_uint8, FRAME_RING_SIZE * int(np.prod(self.shape)))
+
+        # counts the number of empty slots in the ring
+        self.slots = mp.Semaphore(FRAME_RING_SIZE)
+
         return
 
+    def ring(self):
+        """
+        Return a view of the pixel data in the shared frame ring
+        """
+
+        return np.frombuffer(self.pixels, dtype=np.uint8).reshape(FRAME_RING_SIZE, *self.shape)
+
     def start(self):
         self.started.value = 1
+        self.parent_pid = os.getpid()
         super().start()
 
+    def orphaned(self):
+        """
+        Check if the camera process which started this process has exited
+        (e.g., if it was terminated while stopping acquisition)
+        """
+
+        return os.getppid() != self.parent_pid
+
     def join(self, timeout=5):
         """
         """
 
-        # Wait for the video writing to finish
-        while self.q.qsize() != 0:
+        # Wait for the video writing to finish (unless the process has died)
+        while self.q.qsize() != 0 and self.is_alive():
             continue
 
         # Exit from the main loop
@@ -121,6 +283,9 @@ class OpenCVVideoWriterChildProcess(VideoWriterChildProcess):
         """
         """
 
+        # don't inherit the camera process' CPU affinity or scheduling policy
+        restore_scheduling()
+
         # select the appropriate codec
         if self.filename.suffix == '.mp4':
             codec = 'mp4v'
@@ -139,12 +304,17 @@ class OpenCVVideoWriterChildProcess(VideoWriterChildProcess):
             self.color
         )
 
+        pixels = self.ring()
+
         # main loop
         while self.started.value:
             try:
-                image = self.q.get(block=False)
-                writer.write(image)
+                index = self.q.get(block=False)
+                writer.write(pixels[index])
+                self.slots.release()
             except queue.Empty:
+                if self.orphaned():
+                    break
                 continue
 
         # close the writer object
@@ -164,6 +334,9 @@ class SpinnakerVideoWriterChildProcess(VideoWriterChildProcess):
         """
         """
 
+        # don't inherit the camera process' CPU affinity or scheduling policy
+        restore_scheduling()
+
         if self.filename.suffix == '.mp4':
             container = PySpin.MJPGOption()
         elif self.filename.suffix == '.avi':
@@ -179,16 +352,22 @@ class SpinnakerVideoWriterChildProcess(VideoWriterChildProcess):
         writer = PySpin.SpinVideo()
         writer.Open(str(self.filename), container)
 
+        pixels = self.ring()
+
+        if self.color:
+            format = PySpin.PixelFormat_RGB8
+        else:
+            format = PySpin.PixelFormat_Mono8
+
         while self.started.value:
             try:
-                image = self.q.get(block=False)
-                if self.color:
-                    format = PySpin.PixelFormat_RGB8
-                else:
-                    format = PySpin.PixelFormat_Mono8
-                pointer = PySpin.Image_Create(self.width, self.height, 0, 0, format, image)
+                index = self.q.get(block=False)
+                pointer = PySpin.Image_Create(self.width, self.height, 0, 0, format, pixels[index])
                 writer.Append(pointer)
+                self.slots.release()
             except queue.Empty:
+                if self.orphaned():
+                    break
                 continue
 
         writer.Close()
@@ -199,40 +378,84 @@ class FFmpegVideoWriterChildProcess(VideoWriterChildProcess):
 
     def run(self):
 
+        # don't inherit the camera process' CPU affinity or scheduling policy
+        restore_scheduling()
+
         # define the pixel format
         if self.color:
             pixel_format = 'rgb8'
         else:
             pixel_format = 'gray'
 
-        # build a string of args for ffmpeg
-        args = (
-            'ffmpeg',
-            '-y',
-            '-f', 'rawvideo',
-            '-vcodec', 'rawvideo',
-            '-s', f'{self.width}x{self.height}',
-            '-r', f'{self.framerate}',
-            '-pix_fmt', pixel_format,
-            '-i', '-',
-            '-an',
-            '-crf', '0',
-            '-vcodec', 'libx264',
-            str(self.filename)
-        )
-        command = ' '.join(args)
-
-        p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.DEVNULL, stderr=sp.DEVNULL, shell=True)
+        # encode on the GPU if a test encode succeeds (otherwise fall back to
+        # libx264) - both encoders are lossless
+        encoder = FFMPEG_NVENC_ENCODER if detect_nvenc_encoder() else FFMPEG_X264_ENCODER
+
+        def launch(encoder):
+
+            # build a string of args for ffmpeg
+            args = (
+                'ffmpeg',
+                '-y',
+                '-f', 'rawvideo',
+                '-vcodec', 'rawvideo',
+                '-s', f'{self.width}x{self.height}',
+                '-r', f'{self.framerate}',
+                '-pix_fmt', pixel_format,
+                '-i', '-',
+                '-an',
+                *encoder,
+                str(self.filename)
+            )
+            command = ' '.join(args)
+            p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.DEVNULL, stderr=sp.DEVNULL, shell=True)
+
+            # increase the size of the pipe so that it can hold several whole frames
+            resize_pipe(p.stdin.fileno(), PIPE_FRAME_CAPACITY * pixels[0].nbytes)
+
+            return p
+
+        pixels = self.ring()
+        p = launch(encoder)
+        fd = p.stdin.fileno()
+
+        # NVENC can still fail when FFmpeg starts (e.g. no free encoder
+        # sessions) - until the first frame is written FFmpeg is restarted
+        # with libx264 instead
+        written = 0
 
         while self.started.value:
             try:
-                image = self.q.get(block=False)
-                p.stdin.write(image.tobytes())
+                index = self.q.get(block=False)
             except queue.Empty:
+                if self.orphaned():
+                    break
                 continue
 
-        p.stdin.close()
-        p.wait()
+            while True:
+                try:
+                    view = memoryview(pixels[index]).cast('B')
+                    while len(view) > 0:
+                        view = view[os.write(fd, view):]
+                    break
+                except BrokenPipeError:
+                    if written > 0 or encoder is FFMPEG_X264_ENCODER:
+                        raise
+                    p.wait()
+                    encoder = FFMPEG_X264_ENCODER
+                    p = launch(encoder)
+                    fd = p.stdin.fileno()
+
+            written += 1
+            self.slots.release()
+
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = p.wait()
+        if returncode != 0:
+            raise VideoWritingError(f'FFmpeg exited with code {returncode}')
 
         return
 
@@ -240,15 +463,35 @@ class VideoWriter():
     """
     """
 
-    def __init__(self, color=False):
+    def __init__(self, color=False, interpolation='nearest'):
         self.p = None
         self.color = color
+        self.index = 0
+
+        # destination image for pixel format conversion (allocated once) and
+        # the array which backs it
+        self.converted = None
+        self.converted_data = None
+
+        # target pixel format
+        if color:
+            self.format = PySpin.PixelFormat_RGB8
+        else:
+            self.format = PySpin.PixelFormat_Mono8
+
+        # color processing algorithm (only used for non-native pixel formats)
+        if interpolation not in INTERPOLATION_METHODS:
+            raise VideoWritingError(f'{interpolation} is not a valid interpolation method')
+        self.interpolation = INTERPOLATION_METHODS[interpolation]
 
     def open(self, filename):
         if self.p is not None:
             raise VideoWritingError('Video writer is already open')
 
         self.filename = pl.Path(filename)
+        self.index = 0
+        self.converted = None
+        self.converted_data = None
 
         # create the parent directory if necessary
         if not self.filename.parent.exists():
@@ -258,6 +501,31 @@ class VideoWriter():
         if not self.filename.is_absolute():
             self.filename = self.filename.absolute()
 
+    def _map_ring(self):
+        """
+        Map the child process' shared frame ring into this process
+        """
+
+        self.pixels = self.p.ring()
+        self.nbytes = self.pixels[0].nbytes
+        self.addresses = [self.pixels[index].ctypes.data for index in range(FRAME_RING_SIZE)]
+
+        return
+
+    def _allocate_converted(self, pointer):
+        """
+        Create the destination image for converting images like the one given
+        """
+
+        width, height = pointer.GetWidth(), pointer.GetHeight()
+        channels = 3 if self.color else 1
+
+        # the image wraps the array without copying it so the array has to
+        # outlive the image
+        self.converted_data = np.zeros((height, width, channels), dtype=np.uint8)
+
+        return PySpin.Image_Create(width, height, 0, 0, self.format, self.converted_data)
+
     def close(self, timeout=5):
         """
         Close the video writer
@@ -271,39 +539,243 @@ class VideoWriter():
         else:
 
             # The join method will handle all of the cleanup
-            try:
-                self.p.join(timeout)
-                self.p = None
+            p, self.p = self.p, None
+            p.join(timeout)
 
             # Kill the child process if it hangs
-            except mp.TimeoutError:
-                self.p.terminate()
-                self.p.join()
-                self.p = None
+            if p.is_alive():
+                p.terminate()
+                mp.Process.join(p)
                 raise VideoWritingError('Child process was terminated after hanging')
 
+            # The child process failed (e.g. FFmpeg exited with an error)
+            if p.exitcode != 0:
+                raise VideoWritingError(f'Video writer process failed (exit code {p.exitcode})')
+
         return
 
-    def write(self, pointer, dtype=np.uint8):
+    def write(self, pointer):
         """
         Write a single image to the video recording
+
+        Notes
+        -----
+        The image is copied directly into the next empty slot of the shared
+        frame ring and only the index of the slot is sent to the child process
         """
 
         if self.p is None:
             raise VideoWritingError('Video writer is closed')
+
+        if isinstance(pointer, np.ndarray):
+            image = pointer
+        elif isinstance(pointer, PySpin.ImagePtr):
+
+            # only convert images that aren't already in the target pixel format
+            # (into the same destination image instead of a new one every frame)
+            if pointer.GetPixelFormat() != self.format:
+                if self.converted is None:
+                    self.converted = self._allocate_converted(pointer)
+                pointer.Convert(self.converted, self.format, self.interpolation)
+                pointer = self.converted
+            image = pointer.GetNDArray()
         else:
-            if isinstance(pointer, np.ndarray):
-                self.p.q.put(pointer.astype(dtype))
-            elif isinstance(pointer, PySpin.ImagePtr):
-                self.p.q.put(pointer.GetNDArray().astype(dtype))
-            else:
-                raise VideoWritingError(f'Cannot write object of type {type(pointer)} to video file')
+            raise VideoWritingError(f'Cannot write object of type {type(pointer)} to video file')
+
+        # wait for an empty slot (without waiting on a writer process that
+        # has died)
+        while not self.p.slots.acquire(timeout=WRITER_POLLING_INTERVAL):
+            if not self.p.is_alive():
+                raise VideoWritingError(f'Video writer process died (exit code {self.p.exitcode})')
+
+        # copy the image into the slot (memmove releases the GIL)
+        index = self.index
+        if image.dtype == np.uint8 and image.nbytes == self.nbytes and image.flags['C_CONTIGUOUS']:
+            ctypes.memmove(self.addresses[index], image.ctypes.data, self.nbytes)
+        else:
+            np.copyto(self.pixels[index], image.reshape(self.pixels.shape[1:]), casting='unsafe')
+        self.p.q.put(index)
+        self.index = (index + 1) % FRAME_RING_SIZE
+
+        return
+
+class VideoWritingThread():
+    """
+    Submits images to a video writer from a separate thread
+
+    Notes
+    -----
+    The acquisition loop only has to grab and submit each frame. Submitted
+    frames are written (and released) in batches by the writing thread.
+    """
+
+    def __init__(self, writer, maxsize=FRAME_RING_SIZE, release=True):
+        """
+        Keywords
+        --------
+        writer : VideoWriter
+            An open video writer
+        maxsize : int
+            Maximum number of frames waiting to be written
+        release : bool
+            Release each frame after it's written
+        """
+
+        self.writer = writer
+        self.maxsize = maxsize
+        self.release = release
+        self.frames = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        return
+
+    def run(self):
+        """
+        Write batches of submitted frames until the thread is closed
+        """
+
+        # pick the batch handler once instead of branching on every frame
+        if self.release:
+            write_batch, discard_batch = self._write_and_release, self._release
+        else:
+            write_batch, discard_batch = self._write, None
+
+        while True:
+
+            with self.condition:
+                while len(self.frames) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.frames) == 0:
+                    break
+                batch = list(self.frames)
+                self.frames.clear()
+                self.condition.notify_all()
+
+            try:
+                write_batch(batch)
+            except Exception as error:
+                with self.condition:
+                    if self.error is None:
+                        self.error = error
+                    self.condition.notify_all()
+
+                # stop writing after the first error (frames are still released)
+                write_batch = discard_batch if discard_batch is not None else self._discard
+
+        return
+
+    def _write(self, batch):
+        """
+        Write a batch of frames
+        """
+
+        write = self.writer.write
+        for frame in batch:
+            write(frame)
+
+        return
+
+    def _write_and_release(self, batch):
+        """
+        Write and release a batch of frames (every frame is released even if writing fails)
+        """
+
+        write = self.writer.write
+        frames = iter(batch)
+        try:
+            for frame in frames:
+                try:
+                    write(frame)
+                finally:
+                    frame.Release()
+        except Exception:
+            self._release(frames)
+            raise
+
+        return
+
+    def _release(self, batch):
+        """
+        Release a batch of frames without writing them
+        """
+
+        for frame in batch:
+            try:
+                frame.Release()
+            except PySpin.SpinnakerException:
+                pass
+
+        return
+
+    def _discard(self, batch):
+        """
+        Drop a batch of frames
+        """
+
+        return
+
+    def submit(self, frame):
+        """
+        Submit a single frame (blocks while the maximum number of frames are waiting)
+        """
+
+        self.submit_many([frame])
+
+        return
+
+    def submit_many(self, frames):
+        """
+        Submit a batch of frames at once (blocks until there's room for all of them)
+
+        Raises
+        ------
+        VideoWritingError
+            If writing has failed (the frames are still handed to the writing
+            thread which releases them without writing)
+        """
+
+        with self.condition:
+            if self.error is None and len(self.frames) + len(frames) > self.maxsize:
+                warnings.warn(f'Video writing queue is full ({self.maxsize} frames); acquisition is stalled by the writer')
+            while self.error is None and len(self.frames) > 0 and len(self.frames) + len(frames) > self.maxsize:
+                self.condition.wait()
+            self.frames.extend(frames)
+            self.condition.notify_all()
+            error = self.error
+
+        if error is not None:
+            raise VideoWritingError(f'Video writing failed: {error}') from error
+
+        return
+
+    def close(self):
+        """
+        Write any remaining frames and join the writing thread
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
+
+        if self.error is not None:
+            if isinstance(self.error, VideoWritingError):
+                raise self.error
+            raise VideoWritingError(f'Video writing failed: {self.error}') from self.error
+
+        return
 
 class OpenCVVideoWriter(VideoWriter):
     """
     """
 
-    def __init__(self, color=False):
+    def __init__(self, color=False, interpolation='nearest'):
         """
         """
 
@@ -312,7 +784,7 @@ class OpenCVVideoWriter(VideoWriter):
         if OPENCV_IMPORT_RESULT is False:
             raise VideoWritingError('OpenCV (cv2) import failed')
 
-        super().__init__(color)
+        super().__init__(color, interpolation)
 
         return
 
@@ -330,6 +802,7 @@ class OpenCVVideoWriter(VideoWriter):
         }
         self.p = OpenCVVideoWriterChildProcess(**kwargs)
         self.p.start()
+        self._map_ring()
 
         return
 
@@ -337,11 +810,11 @@ class SpinnakerVideoWriter(VideoWriter):
     """
     """
 
-    def __init__(self, color=False):
+    def __init__(self, color=False, interpolation='nearest'):
         """
         """
 
-        super().__init__(color)
+        super().__init__(color, interpolation)
 
         return
 
@@ -360,6 +833,7 @@ class SpinnakerVideoWriter(VideoWriter):
         }
         self.p = SpinnakerVideoWriterChildProcess(**kwargs)
         self.p.start()
+        self._map_ring()
 
         return
 
@@ -373,7 +847,7 @@ class FFmpegVideoWriter(VideoWriter):
     """
     """
 
-    def __init__(self, color=False, print_ffmpeg_path=False):
+    def __init__(self, color=False, interpolation='nearest', print_ffmpeg_path=False):
         """
         """
 
@@ -385,7 +859,7 @@ class FFmpegVideoWriter(VideoWriter):
         elif FFMPEG_BINARY_LOCATED and print_ffmpeg_path:
             print(f'FFmpeg binary located at: {FFMPEG_BINARY_FILEPATH}')
 
-        super().__init__(color)
+        super().__init__(color, interpolation)
 
         return
 
@@ -403,3 +877,11 @@ class FFmpegVideoWriter(VideoWriter):
         }
         self.p = FFmpegVideoWriterChildProcess(**kwargs)
         self.p.start()
+        self._map_ring()
+
+# Video writer class for each backend
+WRITERS = {
+    Backend.FFMPEG    : FFmpegVideoWriter,
+    Backend.SPINNAKER : SpinnakerVideoWriter,
+    Backend.OPENCV    : OpenCVVideoWriter,
+}
@@ -1,12 +1,214 @@
-import dill
+import time
+import queue
 import PySpin
 import numpy as np
 import multiprocessing as mp
 
 # relative imports
 from .dummy import DummyCameraPointer
-from .processes import MainProcess, ChildProcess, CameraError, queued
-from .recording import FFmpegVideoWriter, SpinnakerVideoWriter, OpenCVVideoWriter, VideoWritingError
+from .processes import MainProcess, ChildProcess, CameraError, queued, handler, image_getter, announce_user_buffers, GETBY_DEVICE_INDEX
+from .recording import Backend, WRITERS, VideoWritingThread, VideoWritingError
+
+@handler('secondary')
+def _record(child, pointer, **kwargs):
+    """
+    Configure the hardware trigger and record video (called in the child process)
+    """
+
+    # Set the dummy flag
+    dummy = True if isinstance(pointer, DummyCameraPointer) else False
+
+    # Initialize the video writer (and send the result back to the main process)
+    try:
+        backend = kwargs['backend']
+        writer = WRITERS[backend](color=kwargs['color'], interpolation=kwargs['interpolation'])
+        writer.open(kwargs['filename'], kwargs['shape'], kwargs['framerate'], kwargs['bitrate'])
+        item = (True, None)
+        child.oq.put(item)
+
+    except VideoWritingError as error:
+        item = (
+            False, f'Failed to open video writer (backend={backend.name}): {error}'
+        )
+        child.oq.put(item)
+        return (None, None, None)
+
+    thread = None
+    n = 0
+    try:
+
+        # set the streaming mode to oldest first
+        pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_OldestFirst)
+
+        # configure the hardware trigger for a secondary camera
+        pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+        pointer.TriggerSource.SetValue(PySpin.TriggerSource_Line3)
+        pointer.TriggerOverlap.SetValue(PySpin.TriggerOverlap_ReadOut)
+        pointer.TriggerActivation.SetValue(PySpin.TriggerActivation_RisingEdge)
+        pointer.TriggerMode.SetValue(PySpin.TriggerMode_On)
+
+        # raw timestamps (in ns) and frame ids are stored in shared memory
+        # (timestamps are converted after acquisition is stopped)
+        timestamps = np.frombuffer(child.timestamps, dtype=np.int64)
+        frame_ids = np.frombuffer(child.frame_ids, dtype=np.int64)
+        capacity = timestamps.size
+        child.timestamp_count.value = 0
+
+        # set the number of buffered images (clamped to the device's limits)
+        buffer_count = kwargs['buffer_count']
+        if buffer_count is not None:
+            maximum = pointer.TLStream.StreamBufferCountManual.GetMax()
+            buffer_count = int(min(max(buffer_count, 1), maximum))
+            pointer.TLStream.StreamBufferCountManual.SetValue(buffer_count)
+        else:
+            buffer_count = pointer.TLStream.StreamBufferCountManual.GetValue()
+
+        # preallocate the stream buffers (if requested)
+        if kwargs['user_buffers']:
+            announce_user_buffers(child, pointer, buffer_count)
+
+        # write (and release) frames from a separate thread (which holds at
+        # most all but two of the stream buffers so the driver always has
+        # buffers to fill when the writer falls behind)
+        queue_size = max(buffer_count - 2, 1)
+        thread = VideoWritingThread(writer, maxsize=queue_size, release=not dummy)
+
+        # local references (avoids repeated lookups in the loops below)
+        timeout = kwargs['timeout']
+        safe_get = image_getter(pointer)
+        drop_stale = kwargs['drop_stale']
+        acquiring = child.acquiring
+        shared_frame_counter = child.shared_frame_counter
+        submit = thread.submit
+        monotonic_ns = time.monotonic_ns
+
+        # use the host's monotonic clock instead of the camera's timestamps if
+        # requested (dummy cameras don't have meaningful timestamps)
+        hardware_timestamps = kwargs['hardware_timestamps'] and not dummy
+
+        # begin acquisition
+        pointer.BeginAcquisition()
+
+        # Counts the number of frames in the secondary camera's video recording
+        local_frame_counter = 0
+
+        # Counts the number of stale frames that were dropped
+        dropped = 0
+
+        # main loop (after the acquisition flag is unset the same loop empties
+        # out the computer's device buffer)
+        draining = False
+        while True:
+
+            if not draining and not acquiring.value:
+                draining = True
+
+            # Exit the loop once the counters are equal
+            if draining and local_frame_counter >= shared_frame_counter.value:
+                break
+
+            # The hardware trigger paces real cameras (GetNextImage returns only
+            # after the primary camera exposes the next frame). Dummy cameras
+            # free-run, so they wait for the primary camera's frame counter.
+            if dummy and local_frame_counter >= shared_frame_counter.value:
+                time.sleep(timeout / 1000)
+                continue
+
+            # There's a 1 ms timeout for the call to GetNextImage to prevent
+            # the secondary camera from blocking when video acquisition is
+            # aborted before the primary camera is triggered (see below).
+            frame = safe_get(timeout)
+            if frame is None:
+                if draining:
+                    break
+                continue
+
+            # Release stale frames and keep only the most recent one
+            if drop_stale and not draining:
+                while True:
+                    latest = safe_get(0)
+                    if latest is None:
+                        break
+                    if not dummy:
+                        frame.Release()
+                    frame = latest
+                    dropped += 1
+                    local_frame_counter += 1
+
+            # Incomplete frames are returned to the device buffer
+            if frame.IsIncomplete():
+                frame.Release()
+                continue
+            if n < capacity:
+                if hardware_timestamps:
+                    timestamps[n] = frame.GetTimeStamp()
+                else:
+                    timestamps[n] = monotonic_ns()
+                frame_ids[n] = local_frame_counter
+            n += 1
+            submit(frame)
+
+            # Increment the local frame counter
+            local_frame_counter += 1
+
+        # write any remaining frames
+        thread.close()
+        thread = None
+
+        # stop acquisition
+        pointer.EndAcquisition()
+
+        # reset the trigger mode
+        pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+
+        # close the video writer
+        writer.close()
+
+        return True, dropped, None
+
+    except VideoWritingError as error:
+        return False, None, f'Failed to write video (backend={backend.name}): {error}'
+
+    except PySpin.SpinnakerException:
+        return False, None, f'Video acquisition failed'
+
+    finally:
+
+        # write (or release) any remaining frames, stop acquisition and close
+        # the video writer (also after a failure)
+        if thread is not None:
+            try:
+                thread.close()
+            except VideoWritingError:
+                pass
+        try:
+            if pointer.IsStreaming():
+                pointer.EndAcquisition()
+            pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+        except PySpin.SpinnakerException:
+            pass
+        if writer.p is not None:
+            try:
+                writer.close()
+            except VideoWritingError:
+                pass
+
+        child.timestamp_count.value = n
+
+class SecondaryCameraChildProcess(ChildProcess):
+    """
+    """
+
+    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX, cpu_affinity=None, realtime=False):
+        """
+        """
+
+        super().__init__(value, getby, cpu_affinity, realtime)
+
+        # timestamps of recorded frames
+        self.allocate_timestamp_buffers()
+
+        return
 
 class SecondaryCamera(MainProcess):
     """
@@ -18,14 +220,21 @@ class SecondaryCamera(MainProcess):
         device_index  : int=None,
         nickname      : str=None,
         dummy         : bool=False,
-        color         : bool=False
+        color         : bool=False,
+        cpu_affinity  : int=None,
+        realtime      : bool=False,
+        shutdown_timeout : float=0.5
         ):
         """
         """
 
-        super().__init__(serial_number, device_index, nickname, dummy, color)
-        self._spawn_child_process(ChildProcess)
+        super().__init__(serial_number, device_index, nickname, dummy, color, cpu_affinity, realtime)
+        self._spawn_child_process(SecondaryCameraChildProcess)
         self._primed = False
+        self._dropped = 0
+
+        # interval (in seconds) for checking the child process while stopping
+        self._shutdown_timeout = shutdown_timeout
 
         return
 
@@ -35,7 +244,12 @@ class SecondaryCamera(MainProcess):
         primary_camera_framerate,
         bitrate=1000000,
         backend='Spinnaker',
-        timeout=1
+        timeout=1,
+        interpolation='nearest',
+        drop_stale=False,
+        buffer_count=None,
+        hardware_timestamps=True,
+        user_buffers=False
         ):
         """
         """
@@ -43,148 +257,28 @@ class SecondaryCamera(MainProcess):
         if self.primed:
             raise CameraError('Camera is already primed')
 
+        # resolve the video writing backend (before sending it to the child)
+        try:
+            backend = Backend.from_string(backend)
+        except VideoWritingError as error:
+            raise CameraError(str(error)) from None
+
         if self._child is None:
-            self._spawn_child_process(ChildProcess)
+            self._spawn_child_process(SecondaryCameraChildProcess)
 
         # NOTE - The secondary camera's framerate MUST be less than the primary
         #        camera's framerate (or the frequency of the external sync signal)
         #        or else frames will be dropped by the secondary camera
 
         # check if the secondary camera's framerate is < the primary camera's framerate
-        if self.framerate < primary_camera_framerate:
+        # (the setter stores the resulting framerate so it isn't queried twice)
+        framerate = self.framerate
+        if framerate < primary_camera_framerate:
             self.framerate = 'max'
-        if self.framerate < primary_camera_framerate:
+            framerate = self._framerate
+        if framerate < primary_camera_framerate:
             raise CameraError("Secondary camera's framerate < primary camera's framerate")
 
-        def f(child, pointer, **kwargs):
-
-            # Set the dummy flag
-            dummy = True if isinstance(pointer, DummyCameraPointer) else False
-
-            # Initialize the video writer (and send the result back to the main process)
-            try:
-                backend = kwargs['backend']
-                if backend in ['ffmpeg', 'FFmpeg']:
-                    writer = FFmpegVideoWriter(color=kwargs['color'])
-                elif backend in ['spinnaker', 'Spinnaker', 'PySpin', 'pyspin']:
-                    writer = SpinnakerVideoWriter(color=kwargs['color'])
-                elif backend in ['opencv', 'OpenCV', 'cv2', 'cv']:
-                    writer = OpenCVVideoWriter(color=kwargs['color'])
-                else:
-                    item = (
-                        False, f'{backend} is not a valid video writing backend'
-                    )
-                    child.oq.put(item)
-                    return (None, None, None)
-
-                writer.open(kwargs['filename'], kwargs['shape'], kwargs['framerate'], kwargs['bitrate'])
-                item = (True, None)
-                child.oq.put(item)
-
-            except VideoWritingError as error:
-                item = (
-                    False, f'Failed to open video writer (backend={backend}): {error}'
-                )
-                child.oq.put(item)
-                return (None, None, None)
-
-            try:
-
-                # set the streaming mode to oldest first
-                pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_OldestFirst)
-
-                # configure the hardware trigger for a secondary camera
-                pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
-                pointer.TriggerSource.SetValue(PySpin.TriggerSource_Line3)
-                pointer.TriggerOverlap.SetValue(PySpin.TriggerOverlap_ReadOut)
-                pointer.TriggerActivation.SetValue(PySpin.TriggerActivation_RisingEdge)
-                pointer.TriggerMode.SetValue(PySpin.TriggerMode_On)
-
-                #
-                timestamps = list()
-
-                # begin acquisition
-                pointer.BeginAcquisition()
-
-                # Counts the number of frames in the secondary camera's video recording
-                local_frame_counter = 0
-
-                # main loop
-                while child.acquiring.value:
-
-                    # Wait for the primary camera to begin acquisition of the next frame
-                    if local_frame_counter >= child.shared_frame_counter.value:
-                        continue
-
-                    # There's a 1 ms timeout for the call to GetNextImage to prevent
-                    # the secondary camera from blocking when video acquisition is
-                    # aborted before the primary camera is triggered (see below).
-
-                    try:
-                        frame = pointer.GetNextImage(kwargs['timeout'])
-                        if frame.IsIncomplete():
-                            continue
-                        elif dummy:
-                            writer.write(frame)
-                        else:
-                            if len(timestamps) == 0:
-                                t0 = frame.GetTimeStamp()
-                                timestamps.append(0.0)
-                            else:
-                                tn = (frame.GetTimeStamp() - t0) / 1000000
-                                timestamps.append(tn)
-                            writer.write(frame)
-                            frame.Release()
-
-                        # Increment the local frame counter
-                        local_frame_counter += 1
-
-                    except PySpin.SpinnakerException:
-                        continue
-
-                # Empty out the computer's device buffer
-                while True:
-
-                    # Exit the loop if the counters are equal
-                    if local_frame_counter >= child.shared_frame_counter.value:
-                        break
-
-                    try:
-                        frame = pointer.GetNextImage(kwargs['timeout'])
-                        if frame.IsIncomplete():
-                            continue
-                        elif dummy:
-                            writer.write(frame)
-                        else:
-                            if len(timestamps) == 0:
-                                t0 = frame.GetTimeStamp()
-                                timestamps.append(0.0)
-                            else:
-                                tn = (frame.GetTimeStamp() - t0) / 1000000
-                                timestamps.append(tn)
-                            writer.write(frame)
-                            frame.Release()
-
-                        # Increment the local frame counter
-                        local_frame_counter += 1
-
-                    except PySpin.SpinnakerException:
-                        break
-
-                # stop acquisition
-                pointer.EndAcquisition()
-
-                # reset the trigger mode
-                pointer.TriggerMode.SetValue(PySpin.TriggerMode_Off)
-
-                # close the video writer
-                writer.close()
-
-                return True, timestamps, None
-
-            except PySpin.SpinnakerException:
-                return False, None, f'Video acquisition failed'
-
         # NOTE - The acquisition flag needs to be set here before placing the
         #        acquisition function in the child's input queue
         self._child.acquiring.value = 1
@@ -197,9 +291,14 @@ class SecondaryCamera(MainProcess):
             'bitrate'   : bitrate,
             'backend'   : backend,
             'timeout'   : timeout,
-            'color'     : self.color
+            'color'     : self.color,
+            'interpolation' : interpolation,
+            'buffer_count'  : buffer_count,
+            'hardware_timestamps' : hardware_timestamps,
+            'drop_stale'    : drop_stale,
+            'user_buffers'  : user_buffers
         }
-        item = (dill.dumps(f), kwargs)
+        item = ('secondary', kwargs)
         self._child.iq.put(item)
 
         # check that the video writing setup was successful
@@ -213,8 +312,13 @@ class SecondaryCamera(MainProcess):
 
         return
 
-    def stop(self):
+    def stop(self, timeout=10):
         """
+        Keywords
+        --------
+        timeout : float
+            Time (in seconds) to wait for the child process to finish writing
+            the video before it is terminated
         """
 
         if not self.primed:
@@ -223,13 +327,38 @@ class SecondaryCamera(MainProcess):
         # stop acquisition
         self._child.acquiring.value = 0
 
-        # query the result of video acquisition
-        result, timestamps, message = self._child.oq.get()
+        # query the result of video acquisition (without waiting on a child
+        # process that has died or hangs)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result, output, message = self._child.oq.get(timeout=self._shutdown_timeout)
+                break
+            except queue.Empty:
+                if not self._child.is_alive():
+                    self._primed = False
+                    self._locked = False
+                    self._child = None
+                    raise CameraError('Child process died during acquisition') from None
+                if time.monotonic() > deadline:
+                    self._child.terminate()
+                    self._child.join()
+                    self._primed = False
+                    self._locked = False
+                    self._child = None
+                    raise CameraError('Child process was terminated after failing to stop acquisition') from None
 
         self._primed = False
         self._locked = False
 
-        return np.array(timestamps)
+        if result == False:
+            raise CameraError(message)
+
+        self._dropped = output
+
+        timestamps, self._frame_ids = self._collect_timestamps()
+
+        return timestamps
 
     def release(self):
         """
@@ -242,3 +371,8 @@ class SecondaryCamera(MainProcess):
     @property
     def primed(self):
         return self._primed
+
+    # number of stale frames dropped during the last recording
+    @property
+    def dropped(self):
+        return self._dropped
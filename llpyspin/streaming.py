@@ -1,53 +1,237 @@
-import dill
+import sys
 import queue
+import time
+import ctypes
+import numbers
 import PySpin
 import numpy as np
+import threading
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 
 # relative imports
 from .dummy import DummyCameraPointer
-from .processes  import MainProcess, ChildProcess, CameraError, queued, GETBY_DEVICE_INDEX
+from .processes  import MainProcess, ChildProcess, Channel, CameraError, queued, handler, GETBY_DEVICE_INDEX
 
 
+# Number of image slots in the shared frame buffer (triple buffering)
+STREAMING_BUFFER_SLOTS = 3
+
+# Number of consecutive failures to retrieve an image before acquisition is
+# aborted (and the time in seconds to wait between attempts)
+STREAMING_ERROR_LIMIT = 10
+STREAMING_ERROR_BACKOFF = 0.01
+
+# Properties which can be changed without restarting acquisition
+LIVE_PROPERTIES = ('framerate', 'exposure')
+
+def _set_live_property(pointer, name, value):
+    """
+    Set a property on a camera which is acquiring images (called in the child
+    process)
+    """
+
+    if name not in LIVE_PROPERTIES:
+        return False, None, f'{name} cannot be changed during acquisition'
+    units = 'fps' if name == 'framerate' else 'us'
+    if value != 'max' and (isinstance(value, bool) or not isinstance(value, numbers.Real)):
+        return False, None, f'Target {name} must be a number (or "max"), not {value!r}'
+
+    try:
+        if name == 'framerate':
+            if pointer.AcquisitionFrameRateEnable.GetValue() is False:
+                pointer.AcquisitionFrameRateEnable.SetValue(True)
+            node = pointer.AcquisitionFrameRate
+        else:
+            node = pointer.ExposureTime
+
+        min, max = node.GetMin(), node.GetMax()
+        if value == 'max':
+            value = max
+        if not min <= value <= max:
+            return False, None, f'Target {name} ({value} {units}) falls outside the range of possible values: {min}, {max} {units}'
+        node.SetValue(value)
+
+        # the camera may round the value
+        return True, node.GetValue(), None
+
+    except PySpin.SpinnakerException:
+        return False, None, f'Failed to set {name} to {value} {units}'
+
+@handler('streaming')
 def _acquire(child, pointer, **kwargs):
     """
     Main function for acquiring new frames
+
+    Notes
+    -----
+    GetNextImage blocks until the next frame arrives. A separate thread waits on
+    the control channel - it sets live properties (see LIVE_PROPERTIES) and
+    ends acquisition when it receives None which interrupts the blocking call.
     """
 
     #
     dummy = True if isinstance(pointer, DummyCameraPointer) else False
 
+    # attach to the main process' frame buffer (the main process owns it and
+    # this process shares its resource tracker, see VideoStream.open)
+    if sys.version_info >= (3, 13):
+        buffer = shared_memory.SharedMemory(name=kwargs['buffer'], track=False)
+    else:
+        buffer = shared_memory.SharedMemory(name=kwargs['buffer'])
+    slots = np.ndarray((STREAMING_BUFFER_SLOTS, *kwargs['shape']), dtype=np.uint8, buffer=buffer.buf)
+    frame_count = child.frame_count
+    new_frame = child.new_frame
+    image = None
+    thread = None
+
+    # set by the control thread right before it ends acquisition
+    stopped = threading.Event()
+
+    # slot addresses (for copying with memmove which releases the GIL)
+    nbytes = slots[0].nbytes
+    addresses = [slots[index].ctypes.data for index in range(STREAMING_BUFFER_SLOTS)]
+
+    def control():
+        try:
+            while True:
+                item = child.cq.get()
+                if item is None:
+                    break
+                try:
+                    result = _set_live_property(pointer, *item)
+                except Exception as error:
+                    result = (False, None, f'Failed to set {item[0]}: {error}')
+                child.cr.put(result)
+
+        # acquisition always ends with this thread (which interrupts the
+        # blocking call to GetNextImage)
+        finally:
+            stopped.set()
+            try:
+                pointer.EndAcquisition()
+            except PySpin.SpinnakerException:
+                pass
+
+    # touch every page of the frame buffer before acquisition begins (page
+    # faults happen here instead of on the first few frames, and the pages are
+    # placed on the memory node of the CPU the child process is pinned to)
+    slots.fill(0)
+
     try:
+
+        # only the most recent image is of interest (the driver discards
+        # older images instead of queueing them)
+        pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_NewestOnly)
+
         pointer.BeginAcquisition()
+        thread = threading.Thread(target=control)
+        thread.start()
 
         # main acquisition loop
-        while child.acquiring.value:
+        errors = 0
+        while True:
 
             try:
-                frame = pointer.GetNextImage(kwargs['timeout'])
+                frame = pointer.GetNextImage(PySpin.EVENT_TIMEOUT_INFINITE)
+
+            except PySpin.SpinnakerException as error:
+                if stopped.is_set():
+                    break
+                errors += 1
+                if errors >= STREAMING_ERROR_LIMIT:
+                    return False, None, f'Video acquisition failed: {error}'
+                time.sleep(STREAMING_ERROR_BACKOFF)
+                continue
 
-                #
-                if not frame.IsIncomplete():
+            errors = 0
+
+            #
+            if not frame.IsIncomplete():
+
+                # write the image into the next slot, then publish it by
+                # incrementing the frame count
+                count = frame_count.value + 1
+                index = count % STREAMING_BUFFER_SLOTS
+                data = frame.GetNDArray()
+                if data.dtype == np.uint8 and data.nbytes == nbytes and data.flags['C_CONTIGUOUS']:
+                    ctypes.memmove(addresses[index], data.ctypes.data, nbytes)
+                else:
+                    image = slots[index]
+                    np.copyto(image, data.reshape(image.shape), casting='unsafe')
+                frame_count.value = count
+                new_frame.set()
+
+            # return the buffer to the camera (which fails once acquisition
+            # has ended)
+            if not dummy:
+                try:
+                    frame.Release()
+                except PySpin.SpinnakerException:
+                    if stopped.is_set():
+                        break
+                    raise
 
-                    # store the image (critical - use lock)
-                    with child.qlock:
+        return True, None, None
 
-                        # remove the previous image
-                        if child.buffer.qsize() > 0:
-                            previous = child.buffer.get()
+    except PySpin.SpinnakerException:
+       return False, None, f'Video acquisition failed'
 
-                        # replace with the current image
-                        child.buffer.put(frame.GetNDArray().astype(np.uint8))
+    finally:
 
-            except PySpin.SpinnakerException:
-                continue
+        # wake up the control thread (if acquisition was aborted) and wait for
+        # it to end acquisition (the forked child holds the write end of the
+        # control channel too; the main process flushes it before streaming)
+        if thread is not None:
+            if thread.is_alive():
+                child.cq.put(None)
+            thread.join()
 
-        pointer.EndAcquisition()
+        # live properties can't be changed once acquisition has ended
+        child.acquiring.value = 0
 
-        return True, None, None
+        del slots, image
+        buffer.close()
 
-    except PySpin.SpinnakerException:
-       return False, None, f'Video acquisition failed'
+def _update_live_property_value(fset, name, value, main):
+    """
+    Change the value of an acquisition property while the video stream is
+    acquiring images (see LIVE_PROPERTIES)
+    """
+
+    # acquisition ended on its own (restart it with the new value instead)
+    if main._child.acquiring.value == 0:
+        _update_property_value(fset, value, main)
+        return
+
+    # wait for the result (without waiting on a child process that has died
+    # or a control thread which has already exited)
+    main._child.cq.put((name, value))
+    while True:
+        try:
+            result, output, message = main._child.cr.get(timeout=main._shutdown_timeout)
+            break
+        except queue.Empty:
+            if not main._child.is_alive():
+                raise CameraError('Child process died during acquisition') from None
+
+            # the control thread answers before acquisition ends so the result
+            # is either waiting or the request was never received
+            if main._child.acquiring.value == 0:
+                try:
+                    result, output, message = main._child.cr.get(block=False)
+                    break
+                except queue.Empty:
+                    _update_property_value(fset, value, main)
+                    return
+
+    if result is False:
+        raise CameraError(message)
+
+    # update data
+    setattr(main, f'_{name}', output)
+
+    return
 
 def _update_property_value(fset, value, main):
     """
@@ -59,13 +243,15 @@ def _update_property_value(fset, value, main):
     This function wraps an acquisition property's setter method (see below)
     """
 
-    # pause acquisition
-    if main._child.acquiring.value == 1:
+    # pause acquisition (the child process reports the result of acquisition
+    # even if it has already ended on its own)
+    if main._locked:
         main._child.acquiring.value = 0
+        main._child.cq.put(None)
         try:
             result, output, message = main._child.oq.get(timeout=3)
-        except (mp.TimeoutError, queue.Empty):
-            import pdb; pdb.set_trace()
+        except queue.Empty:
+            raise CameraError('Timed out while pausing acquisition') from None
 
     # unlock the camera
     main._locked = False
@@ -74,13 +260,7 @@ def _update_property_value(fset, value, main):
     fset(main, value)
 
     #unpause acquisition
-    main._child.acquiring.value = 1
-    kwargs = {
-        'shape'   : (main.width, main.height),
-        'timeout' : 1
-    }
-    item = (dill.dumps(_acquire), kwargs)
-    main._child.iq.put(item)
+    main._start_streaming()
 
     # re-engage the lock
     main._locked = True
@@ -92,18 +272,27 @@ class StreamingChildProcess(ChildProcess):
     """
     """
 
-    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX):
+    def __init__(self, value=0, getby=GETBY_DEVICE_INDEX, cpu_affinity=None, realtime=False):
         """
         """
 
         #
-        super().__init__(value, getby)
+        super().__init__(value, getby, cpu_affinity, realtime)
+
+        # The most recent images are stored in shared memory allocated by the
+        # main process (see VideoStream._start_streaming)
+
+        # Number of images stored since acquisition started (image i is stored
+        # in slot i % STREAMING_BUFFER_SLOTS)
+        self.frame_count = mp.Value('q', 0, lock=False)
 
-        # This queue acts as a buffer holding a single image
-        self.buffer = mp.Queue()
+        # Set after each image is stored (see VideoStream.read)
+        self.new_frame = mp.Event()
 
-        # This lock prevents reading and writing to the buffer at the same time
-        self.qlock = mp.Lock()
+        # Control channel for changing live properties and ending acquisition
+        # while the child process is busy acquiring images (and the results)
+        self.cq = Channel()
+        self.cr = Channel()
 
         return
 
@@ -117,12 +306,31 @@ class VideoStream(MainProcess):
         device_index  : int=None,
         nickname      : str=None,
         dummy         : bool=False,
-        color         : bool=False
+        color         : bool=False,
+        cpu_affinity  : int=None,
+        realtime      : bool=False,
+        shutdown_timeout : float=0.5
         ):
         """
         """
 
-        super().__init__(serial_number, device_index, nickname, dummy, color)
+        super().__init__(serial_number, device_index, nickname, dummy, color, cpu_affinity, realtime)
+
+        # interval (in seconds) for checking the child process while closing
+        self._shutdown_timeout = shutdown_timeout
+
+        # shared memory holding the most recent images
+        self._buffer = None
+        self._slots = None
+
+        # frame count of the last image returned by read
+        self._read_count = 0
+
+        # the caller's array last filled by read (and the frame count of the
+        # image it holds)
+        self._out = None
+        self._out_count = 0
+
         self.open()
 
         return
@@ -131,95 +339,210 @@ class VideoStream(MainProcess):
         """
         """
 
-        # spawn a child process as needed
+        # spawn a child process as needed (the resource tracker is started
+        # first so the child inherits it instead of starting its own which
+        # would unlink the frame buffer when the child exits)
         if self._child is None:
+            resource_tracker.ensure_running()
             self._spawn_child_process(StreamingChildProcess)
         else:
             raise CameraError('Video stream is already opened')
 
+        # start acquisition
+        self._start_streaming()
+        self._locked = True
+
+        return
+
+    def _start_streaming(self):
+        """
+        Allocate the frame buffer for the current image shape and start
+        acquisition in the child process
+        """
+
+        # query the image shape (in a single round trip through the queues)
+        @queued
+        def f(child, pointer, **kwargs):
+            try:
+                shape = (pointer.Height.GetValue(), pointer.Width.GetValue())
+                if pointer.PixelFormat.GetValue() == PySpin.PixelFormat_RGB8:
+                    shape = (*shape, 3)
+                return True, shape, None
+            except PySpin.SpinnakerException:
+                return False, None, f'Failed to query the image shape'
+
+        result, shape, message = f(main=self)
+        if not result:
+            raise CameraError(message)
+        self._height, self._width = shape[:2]
+
+        # allocate (or reallocate) the frame buffer
+        if self._slots is None or self._slots.shape[1:] != shape:
+            self._free_buffer()
+            size = STREAMING_BUFFER_SLOTS * int(np.prod(shape))
+            self._buffer = shared_memory.SharedMemory(create=True, size=size)
+            self._slots = np.ndarray((STREAMING_BUFFER_SLOTS, *shape), dtype=np.uint8, buffer=self._buffer.buf)
+
+            # the main process only reads from the frame buffer
+            self._slots.setflags(write=False)
+        self._child.frame_count.value = 0
+        self._read_count = 0
+        self._out = None
+        self._out_count = 0
+
+        # discard a stop signal left over from a failed acquisition
+        self._child.cq.flush()
+
         # set the acquisition flag
         self._child.acquiring.value = 1
 
         # pack the kwargs
         kwargs = {
-            'shape'   : (self.width, self.height),
-            'timeout' : 1
+            'buffer'  : self._buffer.name,
+            'shape'   : shape
         }
-        item = (dill.dumps(_acquire), kwargs)
+        item = ('streaming', kwargs)
         self._child.iq.put(item)
-        self._locked = True
 
         return
 
-    def close(self):
+    def _free_buffer(self):
         """
+        Release the frame buffer
+        """
+
+        if self._buffer is not None:
+            self._slots = None
+            self._buffer.close()
+            self._buffer.unlink()
+            self._buffer = None
+
+        return
+
+    def close(self, timeout=3):
+        """
+        Keywords
+        --------
+        timeout : float
+            Time (in seconds) to wait for acquisition to end before the child
+            process is terminated
         """
 
         # return if there is no active child or the stream is already closed
         if self._child is None:
             raise CameraError('Video stream is already closed')
 
-        # unset the acquisition flag
+        # unset the acquisition flag (and wake up the child process)
         self._child.acquiring.value = 0
+        self._child.cq.put(None)
 
-        # check the result of video acquisition
-        result, output, message = self._child.oq.get()
-        if not result:
-            raise CameraError(message)
-
-        @queued
-        def f(child, pointer, **kwargs):
+        # check the result of video acquisition (without waiting on a child
+        # process that has died or hangs)
+        deadline = time.monotonic() + timeout
+        while True:
             try:
-                if pointer.IsStreaming():
-                    pointer.EndAcquisition()
-                if pointer.IsInitialized():
-                    pointer.DeInit()
-                return True, None, None
-            except PySpin.SpinnakerException:
-                return False, None, f'Failed to deinitialize the camera'
-
-        # check the result
-        result, output, message = f(main=self)
+                result, output, message = self._child.oq.get(timeout=self._shutdown_timeout)
+                break
+            except queue.Empty:
+                if not self._child.is_alive():
+                    self._locked = False
+                    self._free_buffer()
+                    self._child = None
+                    raise CameraError('Child process died during acquisition') from None
+                if time.monotonic() > deadline:
+                    self._child.terminate()
+                    self._child.join()
+                    self._locked = False
+                    self._free_buffer()
+                    self._child = None
+                    raise CameraError('Child process was terminated after failing to stop acquisition') from None
 
         # release the acquisition lock
         self._locked = False
 
-        # flush the buffer and clean up
-        while self._child.buffer.qsize() != 0:
-            discard = self._child.buffer.get()
-        self._child.buffer.close()
-        self._child.buffer.join_thread()
+        # release the frame buffer
+        self._free_buffer()
 
         # join the child process
         self._join_child_process()
 
+        if not result:
+            raise CameraError(message)
+
         return
 
-    def read(self):
+    def read(self, copy=True, out=None, timeout=None):
         """
+        Keywords
+        --------
+        copy : bool
+            Return a new copy of the most recent image on every call, even if
+            it was already read (if False a read-only view into the shared
+            frame buffer is returned instead which is only valid until the
+            child process acquires two more images)
+        out : numpy.ndarray
+            Copy the most recent image into this (uint8) array instead of
+            allocating a new one (nothing is copied if the array already holds
+            the most recent image from the previous call)
+        timeout : float
+            Wait up to this many seconds for an image newer than the one
+            returned by the previous call (by default the most recent image
+            is returned immediately even if it was already read)
         """
 
         # return if there is no active child or the stream is closed
         if self._child is None:
             raise CameraError('Video stream is closed')
 
-        # grab the image most recently buffered image
-        try:
-            with self._child.qlock:
-                image = self._child.buffer.get()
-            return (True, image)
+        frame_count = self._child.frame_count
+
+        # wait for the next image (the event is cleared before checking the
+        # frame count so an image stored in between still wakes this call)
+        if timeout is not None:
+            new_frame = self._child.new_frame
+            new_frame.clear()
+            if frame_count.value == self._read_count and not new_frame.wait(timeout):
+                return (False, None)
+
+        while True:
+
+            # no image has been acquired yet
+            count = frame_count.value
+            if count == 0:
+                return (False, None)
+
+            # view of the most recently published image
+            image = self._slots[count % STREAMING_BUFFER_SLOTS]
+            self._read_count = count
+            if not copy:
+                return (True, image)
+
+            # copy into the caller's array (unless it already holds this image)
+            if out is not None:
+                if out is self._out and count == self._out_count:
+                    return (True, out)
+                np.copyto(out, image)
+                if frame_count.value - count < STREAMING_BUFFER_SLOTS - 1:
+                    self._out, self._out_count = out, count
+                    return (True, out)
+                continue
+
+            image = image.copy()
 
-        except:
-            return (False, None)
+            # the child only writes to this slot again after publishing two
+            # newer images (otherwise the copy might be torn, so try again)
+            if frame_count.value - count < STREAMING_BUFFER_SLOTS - 1:
+                return (True, image)
 
     # override all of the acquisition property's setter methods
+    # (framerate and exposure are changed without restarting acquisition)
     @MainProcess.framerate.setter
     def framerate(self, value):
-        _update_property_value(MainProcess.framerate.fset, value, self)
+        _update_live_property_value(MainProcess.framerate.fset, 'framerate', value, self)
 
     @MainProcess.exposure.setter
     def exposure(self, value):
-        _update_property_value(MainProcess.exposure.fset, value, self)
+        _update_live_property_value(MainProcess.exposure.fset, 'exposure', value, self)
 
     @MainProcess.binsize.setter
     def binsize(self, value):
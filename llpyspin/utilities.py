@@ -1,4 +1,6 @@
+import os
 import PySpin
+import warnings
 
 def camera_count():
     """
@@ -14,3 +16,82 @@ def camera_count():
     del system
 
     return ncameras
+
+# Scheduling policy and CPU affinity of the process before it was changed
+_ORIGINAL_SCHEDULING = None
+
+def set_scheduling(cpu_affinity=None, realtime=False):
+    """
+    Pin the calling process to a set of CPUs and/or switch it to the real-time
+    (SCHED_FIFO) scheduling policy
+
+    Keywords
+    --------
+    cpu_affinity : int or iterable of ints
+        CPU(s) the process is allowed to run on
+    realtime : bool
+        Use the SCHED_FIFO scheduling policy
+
+    Notes
+    -----
+    These calls are only available on Linux. Switching to SCHED_FIFO requires
+    the CAP_SYS_NICE capability (or a suitable RLIMIT_RTPRIO) - if that fails
+    the process' niceness is lowered instead. Processes forked afterwards
+    inherit these settings unless they call restore_scheduling.
+    """
+
+    global _ORIGINAL_SCHEDULING
+
+    if cpu_affinity is None and realtime is False:
+        return
+
+    try:
+        _ORIGINAL_SCHEDULING = (
+            os.sched_getaffinity(0),
+            os.sched_getscheduler(0),
+            os.sched_getparam(0),
+            os.nice(0)
+        )
+    except (AttributeError, OSError):
+        warnings.warn('Process scheduling is not supported on this platform')
+        return
+
+    if cpu_affinity is not None:
+        cpus = {cpu_affinity} if isinstance(cpu_affinity, int) else set(cpu_affinity)
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as error:
+            warnings.warn(f'Failed to set CPU affinity to {cpus}: {error}')
+
+    if realtime:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(50))
+        except OSError:
+            try:
+                os.nice(-10)
+            except OSError as error:
+                warnings.warn(f'Failed to raise the scheduling priority: {error}')
+
+    return
+
+def restore_scheduling():
+    """
+    Undo the changes made by set_scheduling (e.g., in a forked process)
+    """
+
+    global _ORIGINAL_SCHEDULING
+
+    if _ORIGINAL_SCHEDULING is None:
+        return
+
+    affinity, policy, param, niceness = _ORIGINAL_SCHEDULING
+    _ORIGINAL_SCHEDULING = None
+
+    try:
+        os.sched_setaffinity(0, affinity)
+        os.sched_setscheduler(0, policy, param)
+        os.nice(niceness - os.nice(0))
+    except OSError as error:
+        warnings.warn(f'Failed to restore the scheduling policy: {error}')
+
+    return
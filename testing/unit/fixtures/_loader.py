@@ -0,0 +1,22 @@
+import yaml
+import pathlib as pl
+
+# parsed once per test run (every test module imports the cached module)
+camera_settings_filepath = str(pl.Path(__file__).parent.joinpath('camera-settings-data.yml'))
+with open(camera_settings_filepath, 'r') as stream:
+    SETTINGS = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+# serial numbers
+CAMERA_SERIAL_NUMBERS      = SETTINGS['camera_serial_numbers']
+
+# target values for the acquisition properties
+CAMERA_FRAMERATE_TARGET    = SETTINGS['camera_settings_data']['framerate']['target']
+CAMERA_BINSIZE_TARGET      = SETTINGS['camera_settings_data']['binsize']['target']
+CAMERA_WIDTH_TARGET        = SETTINGS['camera_settings_data']['width']['target']
+CAMERA_HEIGHT_TARGET       = SETTINGS['camera_settings_data']['height']['target']
+CAMERA_EXPOSURE_TARGET     = SETTINGS['camera_settings_data']['exposure']['target']
+CAMERA_OFFSET_TARGET       = SETTINGS['camera_settings_data']['offset']['target']
+
+# tolerance for the values of the acquisition properties
+CAMERA_FRAMERATE_TOLERANCE = SETTINGS['camera_settings_data']['framerate']['tolerance']
+CAMERA_EXPOSURE_TOLERANCE  = SETTINGS['camera_settings_data']['exposure']['tolerance']
@@ -0,0 +1,85 @@
+import contextlib
+from ._loader import (
+    CAMERA_FRAMERATE_TARGET,
+    CAMERA_BINSIZE_TARGET,
+    CAMERA_WIDTH_TARGET,
+    CAMERA_HEIGHT_TARGET,
+    CAMERA_EXPOSURE_TARGET,
+    CAMERA_OFFSET_TARGET,
+    CAMERA_FRAMERATE_TOLERANCE,
+    CAMERA_EXPOSURE_TOLERANCE,
+)
+
+# name, target value and tolerance of each property checked after the basic
+# setup (width, height, x and y offset, horizontal and vertical binning,
+# exposure and framerate)
+PROPERTY_TARGETS = (
+    ('width',     CAMERA_WIDTH_TARGET,     0),
+    ('height',    CAMERA_HEIGHT_TARGET,    0),
+    ('offset_x',  CAMERA_OFFSET_TARGET,    0),
+    ('offset_y',  CAMERA_OFFSET_TARGET,    0),
+    ('binsize_x', CAMERA_BINSIZE_TARGET,   0),
+    ('binsize_y', CAMERA_BINSIZE_TARGET,   0),
+    ('exposure',  CAMERA_EXPOSURE_TARGET,  CAMERA_EXPOSURE_TOLERANCE),
+    ('framerate', CAMERA_FRAMERATE_TARGET, CAMERA_FRAMERATE_TOLERANCE),
+)
+
+@contextlib.contextmanager
+def camera_handle(pointer):
+    """
+    Deinitialize the camera pointer on exit (even if a test fails)
+    """
+
+    try:
+        yield pointer
+    finally:
+        if pointer.IsInitialized():
+            pointer.DeInit()
+
+def setup_camera_pointer(pointer):
+    """
+    Run the basic setup for camera pointers
+    """
+
+    # imported here so the fixtures can be loaded without the Spinnaker SDK
+    import PySpin
+
+    #
+    pointer.Init()
+
+    #
+    pointer.PixelFormat.SetValue(PySpin.PixelFormat_Mono8)
+    pointer.AcquisitionMode.SetValue(PySpin.AcquisitionMode_Continuous)
+    pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_NewestOnly)
+
+    # set the exposure
+    pointer.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
+    pointer.AcquisitionFrameRateEnable.SetValue(False)
+    pointer.ExposureTime.SetValue(CAMERA_EXPOSURE_TARGET)
+
+    # set the framerate
+    pointer.AcquisitionFrameRateEnable.SetValue(True)
+    pointer.AcquisitionFrameRate.SetValue(CAMERA_FRAMERATE_TARGET)
+
+    # set the binsize
+    pointer.BinningHorizontal.SetValue(CAMERA_BINSIZE_TARGET)
+    pointer.BinningVertical.SetValue(CAMERA_BINSIZE_TARGET)
+
+    #
+    pointer.OffsetX.SetValue(CAMERA_OFFSET_TARGET)
+    pointer.OffsetY.SetValue(CAMERA_OFFSET_TARGET)
+    pointer.Width.SetValue(CAMERA_WIDTH_TARGET)
+    pointer.Height.SetValue(CAMERA_HEIGHT_TARGET)
+
+    #
+    roi = (
+        pointer.OffsetX.GetValue(),
+        pointer.OffsetY.GetValue(),
+        pointer.Width.GetValue(),
+        pointer.Height.GetValue()
+    )
+    framerate = pointer.AcquisitionFrameRate.GetValue()
+    exposure  = pointer.ExposureTime.GetValue()
+    binsize   = (pointer.BinningHorizontal.GetValue(), pointer.BinningVertical.GetValue())
+
+    return roi, framerate, exposure, binsize
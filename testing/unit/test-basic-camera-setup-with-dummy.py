@@ -1,74 +1,12 @@
-import os
-import yaml
 import PySpin
-import numpy as np
-import pathlib as pl
 import unittest as ut
 from llpyspin.dummy import DummyCameraPointer
 
 # constants
 N_DUMMIES = 3
 
-camera_settings_filepath = str(pl.Path(__file__).parent.joinpath('fixtures/camera-settings-data.yml'))
-with open(camera_settings_filepath, 'r') as stream:
-    camera_settings_data = yaml.load(stream, Loader=yaml.FullLoader)
-
-# target values for the acquisition properties
-CAMERA_FRAMERATE_TARGET    = camera_settings_data['camera_settings_data']['framerate']['target']
-CAMERA_BINSIZE_TARGET      = camera_settings_data['camera_settings_data']['binsize']['target']
-CAMERA_WIDTH_TARGET        = camera_settings_data['camera_settings_data']['width']['target']
-CAMERA_HEIGHT_TARGET       = camera_settings_data['camera_settings_data']['height']['target']
-CAMERA_EXPOSURE_TARGET     = camera_settings_data['camera_settings_data']['exposure']['target']
-CAMERA_OFFSET_TARGET       = camera_settings_data['camera_settings_data']['offset']['target']
-
-# tolerance for the values of the acquisition properties
-CAMERA_FRAMERATE_TOLERANCE = camera_settings_data['camera_settings_data']['framerate']['tolerance']
-CAMERA_EXPOSURE_TOLERANCE  = camera_settings_data['camera_settings_data']['exposure']['tolerance']
-
-def setup_camera_pointer(pointer):
-    """
-    Run the basic setup for camera pointers
-    """
-
-    #
-    pointer.Init()
-
-    #
-    pointer.PixelFormat.SetValue(PySpin.PixelFormat_Mono8)
-    pointer.AcquisitionMode.SetValue(PySpin.AcquisitionMode_Continuous)
-    pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_NewestOnly)
-
-    # set the exposure
-    pointer.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
-    pointer.AcquisitionFrameRateEnable.SetValue(False)
-    pointer.ExposureTime.SetValue(CAMERA_EXPOSURE_TARGET)
-
-    # set the framerate
-    pointer.AcquisitionFrameRateEnable.SetValue(True)
-    pointer.AcquisitionFrameRate.SetValue(CAMERA_FRAMERATE_TARGET)
-
-    # set the binsize
-    pointer.BinningHorizontal.SetValue(CAMERA_BINSIZE_TARGET)
-    pointer.BinningVertical.SetValue(CAMERA_BINSIZE_TARGET)
-
-    #
-    pointer.OffsetX.SetValue(CAMERA_OFFSET_TARGET)
-    pointer.OffsetY.SetValue(CAMERA_OFFSET_TARGET)
-    pointer.Width.SetValue(CAMERA_WIDTH_TARGET)
-    pointer.Height.SetValue(CAMERA_HEIGHT_TARGET)
-
-    #
-    roi = (
-        pointer.OffsetX.GetValue(),
-        pointer.OffsetY.GetValue(),
-        pointer.Width.GetValue(),
-        pointer.Height.GetValue()
-    )
-    framerate = pointer.AcquisitionFrameRate.GetValue()
-    exposure  = pointer.ExposureTime.GetValue()
-    binsize   = (pointer.BinningHorizontal.GetValue(), pointer.BinningVertical.GetValue())
-
-    return roi, framerate, exposure, binsize
+# settings fixture (see fixtures/_setup.py)
+from fixtures._setup import camera_handle, setup_camera_pointer, PROPERTY_TARGETS
 
 class TestBasicCameraSetup(ut.TestCase):
     """
@@ -90,7 +28,6 @@ class TestBasicCameraSetup(ut.TestCase):
 
         for pointer in self.cameras:
             pointer.DeInit()
-            del pointer
 
         return
 
@@ -101,7 +38,6 @@ class TestBasicCameraSetup(ut.TestCase):
         for pointer in self.cameras:
             result = pointer.IsValid()
             self.assertEqual(result, True)
-            del pointer
 
         return
 
@@ -160,58 +96,20 @@ class TestBasicCameraSetup(ut.TestCase):
         """
         """
 
-        # loop through each target serial number
-        for pointer in self.cameras:
+        # loop through each camera
+        for index, pointer in enumerate(self.cameras):
+            with self.subTest(camera=index):
 
-            # run the basic setup and get the results
-            roi, framerate, exposure, binsize = setup_camera_pointer(pointer)
+                # run the basic setup and get the results
+                with camera_handle(pointer):
+                    roi, framerate, exposure, binsize = setup_camera_pointer(pointer)
 
-            # remove the reference to the camera pointer object
-            pointer.DeInit()
-            del pointer
-
-            # check the results
-            x, y, w, h = roi
-            test_property_names = [
-                'width',
-                'height',
-                'offset',
-                'offset',
-                'binsize',
-                'binsize',
-                'exposure',
-                'framerate'
-            ]
-            test_property_values = [
-                CAMERA_WIDTH_TARGET,
-                CAMERA_HEIGHT_TARGET,
-                CAMERA_OFFSET_TARGET,
-                CAMERA_OFFSET_TARGET,
-                CAMERA_BINSIZE_TARGET,
-                CAMERA_BINSIZE_TARGET,
-                CAMERA_EXPOSURE_TARGET,
-                CAMERA_FRAMERATE_TARGET
-            ]
-            actual_property_values = [w, h, x, y, binsize[0], binsize[1], exposure, framerate]
-
-            # pack test data
-            iterable = zip(
-                test_property_names,
-                test_property_values,
-                actual_property_values
-            )
-
-            # run tests
-            for name, target, actual in iterable:
-                if name == 'exposure':
-                    message = f'Actual exposure time of {actual} us is not in the range: {target} +/- {CAMERA_EXPOSURE_TOLERANCE} us'
-                    self.assertTrue(target - CAMERA_EXPOSURE_TOLERANCE <= actual <= target + CAMERA_EXPOSURE_TOLERANCE, message)
-                elif name == 'framerate':
-                    message = f'Actual framerate of {actual} fps is not in the range: {target} +/- {CAMERA_FRAMERATE_TOLERANCE} fps'
-                    self.assertTrue(target - CAMERA_FRAMERATE_TOLERANCE <= actual <= target + CAMERA_FRAMERATE_TOLERANCE, message)
-                else:
-                    message = f'Actual {name} of {actual} is not equal to the target value: {target}'
-                    self.assertAlmostEqual(target, actual, target)
+                # check the results
+                x, y, w, h = roi
+                actual_property_values = (w, h, x, y, binsize[0], binsize[1], exposure, framerate)
+                for (name, target, tolerance), actual in zip(PROPERTY_TARGETS, actual_property_values):
+                    with self.subTest(property=name, target=target):
+                        self.assertLessEqual(abs(actual - target), tolerance)
 
         return
 
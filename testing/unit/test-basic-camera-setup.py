@@ -1,98 +1,54 @@
-import os
-import yaml
-import PySpin
-import numpy as np
-import pathlib as pl
 import unittest as ut
 
-# constants
-USER_HOME_PATH = os.environ['HOME']
+# the Spinnaker SDK is only installed on acquisition machines
+try:
+    import PySpin
+except ImportError:
+    PySpin = None
 
-camera_settings_filepath = str(pl.Path(__file__).parent.joinpath('fixtures/camera-settings-data.yml'))
-with open(camera_settings_filepath, 'r') as stream:
-    camera_settings_data = yaml.load(stream, Loader=yaml.FullLoader)
-
-# serial numbers
-CAMERA_SERIAL_NUMBERS      = camera_settings_data['camera_serial_numbers']
-
-# target values for the acquisition properties
-CAMERA_FRAMERATE_TARGET    = camera_settings_data['camera_settings_data']['framerate']['target']
-CAMERA_BINSIZE_TARGET      = camera_settings_data['camera_settings_data']['binsize']['target']
-CAMERA_WIDTH_TARGET        = camera_settings_data['camera_settings_data']['width']['target']
-CAMERA_HEIGHT_TARGET       = camera_settings_data['camera_settings_data']['height']['target']
-CAMERA_EXPOSURE_TARGET     = camera_settings_data['camera_settings_data']['exposure']['target']
-CAMERA_OFFSET_TARGET       = camera_settings_data['camera_settings_data']['offset']['target']
-
-# tolerance for the values of the acquisition properties
-CAMERA_FRAMERATE_TOLERANCE = camera_settings_data['camera_settings_data']['framerate']['tolerance']
-CAMERA_EXPOSURE_TOLERANCE  = camera_settings_data['camera_settings_data']['exposure']['tolerance']
-
-def setup_camera_pointer(pointer):
-    """
-    Run the basic setup for camera pointers
-    """
-
-    #
-    pointer.Init()
-
-    #
-    pointer.PixelFormat.SetValue(PySpin.PixelFormat_Mono8)
-    pointer.AcquisitionMode.SetValue(PySpin.AcquisitionMode_Continuous)
-    pointer.TLStream.StreamBufferHandlingMode.SetValue(PySpin.StreamBufferHandlingMode_NewestOnly)
-
-    # set the exposure
-    pointer.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
-    pointer.AcquisitionFrameRateEnable.SetValue(False)
-    pointer.ExposureTime.SetValue(CAMERA_EXPOSURE_TARGET)
-
-    # set the framerate
-    pointer.AcquisitionFrameRateEnable.SetValue(True)
-    pointer.AcquisitionFrameRate.SetValue(CAMERA_FRAMERATE_TARGET)
-
-    # set the binsize
-    pointer.BinningHorizontal.SetValue(CAMERA_BINSIZE_TARGET)
-    pointer.BinningVertical.SetValue(CAMERA_BINSIZE_TARGET)
-
-    #
-    pointer.OffsetX.SetValue(CAMERA_OFFSET_TARGET)
-    pointer.OffsetY.SetValue(CAMERA_OFFSET_TARGET)
-    pointer.Width.SetValue(CAMERA_WIDTH_TARGET)
-    pointer.Height.SetValue(CAMERA_HEIGHT_TARGET)
-
-    #
-    roi = (
-        pointer.OffsetX.GetValue(),
-        pointer.OffsetY.GetValue(),
-        pointer.Width.GetValue(),
-        pointer.Height.GetValue()
-    )
-    framerate = pointer.AcquisitionFrameRate.GetValue()
-    exposure  = pointer.ExposureTime.GetValue()
-    binsize   = (pointer.BinningHorizontal.GetValue(), pointer.BinningVertical.GetValue())
-
-    return roi, framerate, exposure, binsize
+# settings fixture (see fixtures/_loader.py)
+from fixtures._loader import CAMERA_SERIAL_NUMBERS
+from fixtures._setup import camera_handle, setup_camera_pointer, PROPERTY_TARGETS
 
 class TestBasicCameraSetup(ut.TestCase):
     """
     """
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """
+        Enumerate the cameras once for all tests
         """
 
-        self.system = PySpin.System.GetInstance()
-        self.cameras = self.system.GetCameras()
+        if PySpin is None:
+            raise ut.SkipTest('PySpin is not installed')
+
+        cls.system = PySpin.System.GetInstance()
+        cls.cameras = cls.system.GetCameras()
+
+        # skip the whole class on machines without cameras (tearDownClass
+        # isn't called if setUpClass raises)
+        if cls.cameras.GetSize() == 0:
+            cls.tearDownClass()
+            raise ut.SkipTest('No cameras detected')
+
+        # skip it too if any of the configured cameras is missing (the
+        # pointers are released before the camera list is cleared)
+        serials = {pointer.TLDevice.DeviceSerialNumber.GetValue() for pointer in cls.cameras}
+        missing = [serialno for serialno in CAMERA_SERIAL_NUMBERS if str(serialno) not in serials]
+        if missing:
+            cls.tearDownClass()
+            raise ut.SkipTest(f'Cameras not detected: {missing}')
 
         return
 
-    def tearDown(self):
+    @classmethod
+    def tearDownClass(cls):
         """
         """
 
-        self.cameras.Clear()
-        del self.cameras
-        self.system.ReleaseInstance()
-        del self.system
+        cls.cameras.Clear()
+        cls.system.ReleaseInstance()
 
         return
 
@@ -101,10 +57,9 @@ class TestBasicCameraSetup(ut.TestCase):
         """
 
         for serialno in CAMERA_SERIAL_NUMBERS:
-            pointer = self.cameras.GetBySerial(str(serialno))
-            result = pointer.IsValid()
-            self.assertEqual(result, True)
-            del pointer
+            with self.subTest(serialno=serialno):
+                with camera_handle(self.cameras.GetBySerial(str(serialno))) as pointer:
+                    self.assertEqual(pointer.IsValid(), True)
 
         return
 
@@ -131,31 +86,31 @@ class TestBasicCameraSetup(ut.TestCase):
 
         # iterate through each available camera
         for pointer in self.cameras:
+            with camera_handle(pointer):
+                # make sure the pointer is initialized
+                if not pointer.IsInitialized():
+                    pointer.Init()
+
+                # collect properties in a list
+                properties = [
+                    pointer.PixelFormat,
+                    pointer.AcquisitionMode,
+                    pointer.TLStream.StreamBufferHandlingMode,
+                    pointer.ExposureAuto,
+                    pointer.AcquisitionFrameRateEnable,
+                    pointer.ExposureTime,
+                    pointer.AcquisitionFrameRate,
+                    pointer.OffsetX,
+                    pointer.OffsetY,
+                    pointer.Width,
+                    pointer.Height,
+                    pointer.BinningHorizontal,
+                    pointer.BinningVertical
+                ]
 
-            # make sure the pointer is initialized
-            if not pointer.IsInitialized():
-                pointer.Init()
-
-            # collect properties in a list
-            properties = [
-                pointer.PixelFormat,
-                pointer.AcquisitionMode,
-                pointer.TLStream.StreamBufferHandlingMode,
-                pointer.ExposureAuto,
-                pointer.AcquisitionFrameRateEnable,
-                pointer.ExposureTime,
-                pointer.AcquisitionFrameRate,
-                pointer.OffsetX,
-                pointer.OffsetY,
-                pointer.Width,
-                pointer.Height,
-                pointer.BinningHorizontal,
-                pointer.BinningVertical
-            ]
-
-            # run tests
-            for property, message in zip(properties, messages):
-                self.assertEqual(property.GetAccessMode(), PySpin.RW, message)
+                # run tests
+                for property, message in zip(properties, messages):
+                    self.assertEqual(property.GetAccessMode(), PySpin.RW, message)
 
         return
 
@@ -165,59 +120,18 @@ class TestBasicCameraSetup(ut.TestCase):
 
         # loop through each target serial number
         for serialno in CAMERA_SERIAL_NUMBERS:
-
-            # instantiate the pointer
-            pointer = self.cameras.GetBySerial(str(serialno))
-
-            # run the basic setup and get the results
-            roi, framerate, exposure, binsize = setup_camera_pointer(pointer)
-
-            # remove the reference to the camera pointer object
-            pointer.DeInit()
-            del pointer
-
-            # check the results
-            x, y, w, h = roi
-            test_property_names = [
-                'width',
-                'height',
-                'offset',
-                'offset',
-                'binsize',
-                'binsize',
-                'exposure',
-                'framerate'
-            ]
-            test_property_values = [
-                CAMERA_WIDTH_TARGET,
-                CAMERA_HEIGHT_TARGET,
-                CAMERA_OFFSET_TARGET,
-                CAMERA_OFFSET_TARGET,
-                CAMERA_BINSIZE_TARGET,
-                CAMERA_BINSIZE_TARGET,
-                CAMERA_EXPOSURE_TARGET,
-                CAMERA_FRAMERATE_TARGET
-            ]
-            actual_property_values = [w, h, x, y, binsize[0], binsize[1], exposure, framerate]
-
-            # pack test data
-            iterable = zip(
-                test_property_names,
-                test_property_values,
-                actual_property_values
-            )
-
-            # run tests
-            for name, target, actual in iterable:
-                if name == 'exposure':
-                    message = f'Actual exposure time of {actual} us is not in the range: {target} +/- {CAMERA_EXPOSURE_TOLERANCE} us'
-                    self.assertTrue(target - CAMERA_EXPOSURE_TOLERANCE <= actual <= target + CAMERA_EXPOSURE_TOLERANCE, message)
-                elif name == 'framerate':
-                    message = f'Actual framerate of {actual} fps is not in the range: {target} +/- {CAMERA_FRAMERATE_TOLERANCE} fps'
-                    self.assertTrue(target - CAMERA_FRAMERATE_TOLERANCE <= actual <= target + CAMERA_FRAMERATE_TOLERANCE, message)
-                else:
-                    message = f'Actual {name} of {actual} is not equal to the target value: {target}'
-                    self.assertAlmostEqual(target, actual, target)
+            with self.subTest(serialno=serialno):
+
+                # run the basic setup and get the results
+                with camera_handle(self.cameras.GetBySerial(str(serialno))) as pointer:
+                    roi, framerate, exposure, binsize = setup_camera_pointer(pointer)
+
+                # check the results
+                x, y, w, h = roi
+                actual_property_values = (w, h, x, y, binsize[0], binsize[1], exposure, framerate)
+                for (name, target, tolerance), actual in zip(PROPERTY_TARGETS, actual_property_values):
+                    with self.subTest(property=name, target=target):
+                        self.assertLessEqual(abs(actual - target), tolerance)
 
         return
 
@@ -1,37 +1,31 @@
 import time
-import queue
 import unittest as ut
 import multiprocessing as mp
 
 NPROCESSES = 5
 
-class TestProcess(mp.Process):
+# this test checks forking processes (and forked children don't re-import
+# this module like spawned children do)
+CTX = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+
+class TestProcess(CTX.Process):
     """
     """
 
     def __init__(self):
         super().__init__()
-        self.started = mp.Value('i', 0)
-        self.iq = mp.Queue()
-        self.oq = mp.Queue()
+        self.stopped = CTX.Event()
+        self.parent_conn, self.child_conn = CTX.Pipe(duplex=True)
 
     def run(self):
-        while self.started.value:
-            try:
-                item = self.iq.get(block=False)
-                self.oq.put(item)
-            except queue.Empty:
-                pass
-            continue
-        return
-
-    def start(self):
-        self.started.value = 1
-        super().start()
+        while not self.stopped.is_set():
+            if self.child_conn.poll(0.1):
+                item = self.child_conn.recv()
+                self.child_conn.send(item)
         return
 
     def join(self):
-        self.started.value = 0
+        self.stopped.set()
         super().join()
         return
 
@@ -49,10 +43,10 @@ class TestMultiprocessingFunction(ut.TestCase):
         for p in children:
             p.start()
 
-        # pass an object throught the queues
+        # pass an object through the pipes
         for p in children:
-            p.iq.put('Hello World!')
-            item = p.oq.get()
+            p.parent_conn.send('Hello World!')
+            item = p.parent_conn.recv()
 
         # join the child processes
         for p in children: